@@ -0,0 +1,100 @@
+"""
+Compare CPU inference of the detector in float32 and with dynamic int8 quantization.
+
+Sample rows of a prompt file (by default datasets/test_tatqa.csv) are generated one at
+a time with greedy decoding by each variant. The script reports load time, mean and
+p90 latency per row and generated tokens per second, and how many outputs of the int8
+model match the float32 ones.
+
+Usage:
+    cd benchmarks
+    python bench_cpu_inference.py --checkpoint_dir {checkpoint_dir} --num_rows 8 --cpu_threads 16
+"""
+import argparse
+import statistics
+import sys
+import os
+import time
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, "evaluation"))
+from utils import read_table
+from cpu_backend import load_cpu_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="checkpoint of the fine-tuned model")
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        default=os.path.join(parent_dir, "datasets", "test_tatqa.csv"),
+        help="file with a prompt column to sample rows from")
+    parser.add_argument(
+        "--num_rows",
+        type=int,
+        default=8,
+        help="number of rows generated per variant")
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=256,
+        help="max_new_tokens per row")
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        default=None,
+        help="number of threads for CPU inference (default: all cores)")
+    args = parser.parse_args()
+    return args
+
+
+def run_variant(args, quantize, prompts):
+    start = time.perf_counter()
+    model, tokenizer = load_cpu_model(args.checkpoint_dir, quantize, args.cpu_threads)
+    load_seconds = time.perf_counter() - start
+
+    latencies, new_tokens, outputs = [], 0, []
+    for prompt in prompts:
+        inputs = tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}],
+            tokenize = True,
+            add_generation_prompt = True,
+            return_tensors = "pt",
+        )
+        start = time.perf_counter()
+        generated = model.generate(input_ids = inputs, max_new_tokens = args.max_new_tokens, do_sample = False, use_cache = True)
+        latencies.append(time.perf_counter() - start)
+        generated = generated[0, inputs.shape[1]:]
+        new_tokens += len(generated)
+        outputs.append(tokenizer.decode(generated, skip_special_tokens=True))
+
+    latencies.sort()
+    stats = {
+        "variant": quantize,
+        "load_s": round(load_seconds, 1),
+        "mean_latency_s": round(statistics.mean(latencies), 2),
+        "p90_latency_s": round(latencies[int(0.9 * (len(latencies) - 1))], 2),
+        "tokens_per_s": round(new_tokens / sum(latencies), 2),
+    }
+    return stats, outputs
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    prompts = read_table(args.input_file, columns=["prompt"])["prompt"].head(args.num_rows).tolist()
+
+    baseline, baseline_outputs = run_variant(args, "none", prompts)
+    quantized, quantized_outputs = run_variant(args, "int8", prompts)
+    quantized["same_output"] = sum(a == b for a, b in zip(baseline_outputs, quantized_outputs))
+
+    for stats in [baseline, quantized]:
+        print(stats)
+    print(f"int8 speedup: {quantized['tokens_per_s'] / baseline['tokens_per_s']:.2f}x tokens/s")
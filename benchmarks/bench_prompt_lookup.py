@@ -0,0 +1,91 @@
+"""
+Compare prompt-lookup speculative decoding with plain greedy decoding.
+
+Sample rows of a prompt file (by default datasets/test_tatqa.csv) are generated one at
+a time with both methods. The script reports tokens per second of each, the draft
+acceptance rate and forward passes of prompt lookup, and how many outputs are identical,
+which under greedy decoding should be all of them.
+
+Usage:
+    cd benchmarks
+    python bench_prompt_lookup.py --checkpoint_dir {checkpoint_dir} --num_rows 16
+"""
+import argparse
+import sys
+import os
+import time
+from collections import Counter
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+sys.path.append(os.path.join(parent_dir, "evaluation"))
+from utils import read_table
+from phi_4_inference import load_model, generate_batch, generate_prompt_lookup
+from pretokenize import render_prompt
+from passage_stopping import extract_passage
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="checkpoint of the fine-tuned model")
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        default=os.path.join(parent_dir, "datasets", "test_tatqa.csv"),
+        help="file with a prompt column to sample rows from")
+    parser.add_argument(
+        "--num_rows",
+        type=int,
+        default=16,
+        help="number of rows generated per method")
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=1024,
+        help="max_new_tokens per row")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda",
+        choices=["cuda", "cpu"],
+        help="device to run on")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    model, tokenizer = load_model(args.checkpoint_dir, args.device)
+    rows = read_table(args.input_file, columns=["prompt"])["prompt"].head(args.num_rows).tolist()
+    prompts = [tokenizer(render_prompt(tokenizer, row), add_special_tokens=False)["input_ids"] for row in rows]
+    passages = [extract_passage(row) for row in rows]
+    passage_ids = [tokenizer(passage, add_special_tokens=False)["input_ids"] for passage in passages]
+
+    results = {}
+    lookup_stats = Counter()
+    for method in ["greedy", "prompt_lookup"]:
+        outputs, num_tokens = [], 0
+        start = time.perf_counter()
+        for prompt, passage, source in zip(prompts, passages, passage_ids):
+            if method == "greedy":
+                generated = generate_batch(model, tokenizer, [prompt], [passage], [args.max_new_tokens], args.device, greedy=True)[0]
+            else:
+                generated, stats = generate_prompt_lookup(model, tokenizer, prompt, passage, source, args.max_new_tokens, args.device)
+                lookup_stats.update(stats)
+            outputs.append(generated)
+            num_tokens += len(generated)
+        seconds = time.perf_counter() - start
+        results[method] = outputs
+        print(f"{method:<14} {num_tokens} tokens in {seconds:.1f}s ({num_tokens / seconds:.1f} tokens/s)")
+
+    print(f"Acceptance rate: {lookup_stats['accepted'] / max(lookup_stats['drafted'], 1):.1%} "
+          f"({lookup_stats['accepted']} of {lookup_stats['drafted']} draft tokens), "
+          f"{lookup_stats['forward_passes']} forward passes")
+    identical = sum(a == b for a, b in zip(results["greedy"], results["prompt_lookup"]))
+    print(f"Identical outputs: {identical} of {len(rows)}")
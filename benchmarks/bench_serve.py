@@ -0,0 +1,79 @@
+"""
+Load test of the detection service (evaluation/serve.py).
+
+Rows of a prompt file (by default datasets/test_tatqa.csv) are split back into
+references and passage and sent to `/detect` by `--concurrency` parallel clients. The
+script reports request throughput and client-side latency percentiles, followed by the
+service's own `/metrics` (batch sizes, queue and generation latency).
+
+Usage:
+    cd evaluation && python serve.py --checkpoint_dir {checkpoint_dir} --port 8080 &
+    cd benchmarks && python bench_serve.py --url http://localhost:8080 --num_requests 64 --concurrency 16
+"""
+import argparse
+import json
+import sys
+import os
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import read_table, extract_references_and_passage
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--url",
+        type=str,
+        default="http://localhost:8080",
+        help="base URL of the service")
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        default=os.path.join(parent_dir, "datasets", "test_tatqa.csv"),
+        help="file with a prompt column to take requests from")
+    parser.add_argument(
+        "--num_requests",
+        type=int,
+        default=64,
+        help="number of requests sent")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=16,
+        help="number of parallel clients")
+    args = parser.parse_args()
+    return args
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        json.loads(response.read())
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    prompts = read_table(args.input_file, columns=["prompt"])["prompt"].tolist()
+    requests = []
+    for i in range(args.num_requests):
+        references, passage = extract_references_and_passage(prompts[i % len(prompts)])
+        requests.append({"references": references, "passage": passage})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        latencies = sorted(executor.map(lambda body: post(args.url + "/detect", body), requests))
+    seconds = time.perf_counter() - start
+
+    percentile = lambda q: latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+    print(f"{len(latencies)} requests in {seconds:.1f}s ({len(latencies) / seconds:.2f} requests/s), "
+          f"latency p50 {percentile(0.5):.2f}s p90 {percentile(0.9):.2f}s max {latencies[-1]:.2f}s")
+    with urllib.request.urlopen(args.url + "/metrics") as response:
+        print(json.dumps(json.loads(response.read()), indent=2))
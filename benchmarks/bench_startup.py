@@ -0,0 +1,64 @@
+"""
+Measure the startup time of every `cli.py` command.
+
+Each command is started in a fresh interpreter with `--help`, which parses the
+arguments and exits, so the time is what the command pays for imports before doing
+any work. A bare `python -c pass` is measured as the baseline.
+
+Usage:
+    cd benchmarks
+    python bench_startup.py --repeats 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import os
+import time
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from cli import COMMANDS, ROOT
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--commands",
+        type=str,
+        nargs="+",
+        default=list(COMMANDS),
+        help="commands to measure (default: all)")
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=5,
+        help="runs per command, the median is reported")
+    args = parser.parse_args()
+    return args
+
+
+def measure(argv, repeats):
+    times = []
+    returncode = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        returncode = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), min(times), returncode
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    cli = os.path.join(ROOT, "cli.py")
+    runs = [("(python baseline)", [sys.executable, "-c", "pass"])]
+    runs += [(command, [sys.executable, cli, command, "--help"]) for command in args.commands]
+
+    print(f"{'command':<20}{'median s':>10}{'min s':>10}  status")
+    for name, argv in runs:
+        median, fastest, returncode = measure(argv, args.repeats)
+        # A non-zero status usually means a dependency of the command is not installed
+        status = "ok" if returncode == 0 else f"exit {returncode}"
+        print(f"{name:<20}{median:>10.3f}{fastest:>10.3f}  {status}")
@@ -0,0 +1,106 @@
+"""
+Benchmark the tag utilities of utils.py on adversarial, malformed model outputs.
+
+Each case is built at growing sizes and run through both the single-scan parser based
+utilities and the previous multi-pass regex implementations kept below for reference.
+The parser should grow linearly with the input size, the regex versions quadratically
+on unclosed tags.
+
+Usage:
+    cd benchmarks
+    python bench_tag_parser.py --sizes 250 500 1000 2000 --regex_max_size 500
+"""
+import argparse
+import re
+import sys
+import os
+import time
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import recover_original_string, remove_tagged_spans, contain_nested_tags, swap_error_tags
+
+NESTING_TAGS = ["entity", "relation", "temporal", "numerical", "contradictory", "unverifiable"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[250, 500, 1000, 2000],
+        help="number of repeated fragments in each adversarial passage")
+    parser.add_argument(
+        "--regex_max_size",
+        type=int,
+        default=500,
+        help="largest size also run through the regex versions, which take minutes beyond it")
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="runs per measurement, the fastest one is reported")
+    args = parser.parse_args()
+    return args
+
+
+### Previous regex implementations, for reference
+def regex_recover_original_string(text):
+    text = re.sub(r"<contradictory>.*?</contradictory>", "", text, flags=re.DOTALL)
+    text = re.sub(r"<unverifiable>.*?</unverifiable>", "", text, flags=re.DOTALL)
+    for tag in ["entity", "numerical", "temporal", "relation"]:
+        text = re.sub(fr"<{tag}><delete>(.*?)</delete><mark>.*?</mark></{tag}>", r"\1", text, flags=re.DOTALL)
+    return text.strip()
+
+
+def regex_remove_tagged_spans(text):
+    for tag in ["unverifiable", "contradictory", "invented", "subjective"]:
+        text = re.sub(fr"<{tag}>.*?</{tag}>", "", text, flags=re.DOTALL)
+    return text
+
+
+### Adversarial passages
+CASES = {
+    # Every opening tag makes the lazy regex scan to the end of the passage
+    "unclosed_passage_tags": lambda n: "<contradictory>The margin rose. " * n,
+    "unclosed_edit_pairs": lambda n: "<entity><delete>Acme</delete><mark>Globex " * n,
+    "stray_closing_tags": lambda n: "</delete></mark></entity> revenue " * n,
+    "deep_nesting": lambda n: "<unverifiable><numerical>" * n + "1.5" + "</numerical></unverifiable>" * n,
+    "well_formed": lambda n: "Sales <relation><delete>rose</delete><mark>fell</mark></relation> in "
+                             "<temporal><delete>2019</delete><mark>2018</mark></temporal>. " * n,
+}
+
+FUNCTIONS = {
+    "recover_original_string": (recover_original_string, regex_recover_original_string),
+    "remove_tagged_spans": (remove_tagged_spans, regex_remove_tagged_spans),
+    "contain_nested_tags": (lambda text: contain_nested_tags(NESTING_TAGS, text), None),
+    "swap_error_tags": (swap_error_tags, None),
+}
+
+
+def measure(fn, text, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    print(f"{'case':<24}{'function':<26}{'size':>8}{'chars':>10}{'parser ms':>12}{'regex ms':>12}")
+    for case, build in CASES.items():
+        for name, (fn, regex_fn) in FUNCTIONS.items():
+            for size in args.sizes:
+                text = build(size)
+                parser_ms = measure(fn, text, args.repeats) * 1000
+                regex_ms = float("nan")
+                if regex_fn is not None and size <= args.regex_max_size:
+                    regex_ms = measure(regex_fn, text, args.repeats) * 1000
+                    if case == "well_formed":
+                        assert fn(text) == regex_fn(text), f"{name} differs from the regex version on {case}"
+                print(f"{case:<24}{name:<26}{size:>8}{len(text):>10}{parser_ms:>12.2f}{regex_ms:>12.2f}")
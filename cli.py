@@ -0,0 +1,79 @@
+"""
+Single command line entry point for all pipeline stages.
+
+Usage:
+    python cli.py <command> [args...]
+    hde <command> [args...]            # after `pip install -e .`
+
+Only the script of the selected command is imported, so heavy dependencies (spaCy,
+unsloth, datasets, the LLM clients) are loaded only by the commands that use them, and
+`hde <command> --help` returns without loading any model.
+"""
+import argparse
+import os
+import runpy
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# command -> (script relative to the repository root, description)
+COMMANDS = {
+    "insert": ("data_preparation/insert_errors.py", "insert synthetic errors into responses with an LLM"),
+    "verify": ("data_preparation/verify_responses.py", "filter generated responses and correct tag types"),
+    "convert": ("data_preparation/convert_format.py", "convert verified responses to prompt/completion pairs"),
+    "pipeline": ("data_preparation/run_pipeline.py", "run insert, verify and convert as one streaming process"),
+    "mock-server": ("data_preparation/mock_llm_server.py", "serve an offline OpenAI-compatible mock LLM"),
+    "infer": ("evaluation/phi_4_inference.py", "run the fine-tuned model on a prompt file"),
+    "infer-sharded": ("evaluation/shard_inference.py", "run inference as several shard workers and merge their outputs"),
+    "serve": ("evaluation/serve.py", "serve the fine-tuned model over HTTP with micro-batching"),
+    "postprocess": ("evaluation/postprocess.py", "correct fixable errors in model completions"),
+    "eval-detection": ("evaluation/eval_detection.py", "compute sentence- and passage-level detection scores"),
+    "eval-factscore": ("evaluation/eval_factscore.py", "compute the FactScore of edited passages"),
+}
+
+
+def run_command(command, argv):
+    """Run the script of `command` as __main__ with `argv` as its command line arguments."""
+    script = os.path.join(ROOT, COMMANDS[command][0])
+    # Scripts import the shared root modules and their sibling modules
+    for path in [ROOT, os.path.dirname(script)]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # runpy.run_path sets sys.argv[0] to the script path, so the usage line of the script's
+    # parser is named `hde <command>` through the default prog instead
+    sys.argv = [script] + list(argv)
+    init = argparse.ArgumentParser.__init__
+
+    def init_with_prog(self, *args, **kwargs):
+        if not args:
+            kwargs.setdefault("prog", f"hde {command}")
+        init(self, *args, **kwargs)
+
+    argparse.ArgumentParser.__init__ = init_with_prog
+    try:
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        argparse.ArgumentParser.__init__ = init
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="hde",
+        description="Hallucination detection and editing pipeline.",
+        epilog="commands:\n" + "\n".join(f"  {name:<16}{description}" for name, (_, description) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "command",
+        choices=list(COMMANDS),
+        metavar="command",
+        help="pipeline stage to run, see below")
+    parser.add_argument(
+        "args",
+        nargs=argparse.REMAINDER,
+        help="arguments of the command, see `hde <command> --help`")
+    args = parser.parse_args(argv)
+    run_command(args.command, args.args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def write_batch_file(path, requests, model_name, max_tokens, temperature):
+    """
+    Write chat completion requests in the provider batch JSONL format.
+
+    Args:
+        path (str): Output .jsonl path.
+        requests (list of (str, list)): (custom_id, messages) pairs.
+        model_name (str): Model used for every request.
+        max_tokens (int): max_tokens of every request.
+        temperature (float): Temperature of every request.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for custom_id, messages in requests:
+            line = {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model_name,
+                    "messages": messages,
+                    "response_format": {"type": "json_object"},
+                    "temperature": temperature,
+                    "max_tokens": int(max_tokens),
+                },
+            }
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+
+def parse_batch_output(text):
+    """Parse a batch output/error JSONL file into a dict keyed by custom_id."""
+    results = {}
+    for line in text.splitlines():
+        if line.strip():
+            record = json.loads(line)
+            results[record["custom_id"]] = record
+    return results
+
+
+def batch_record_content(record):
+    """
+    Return (content, error_message) for one batch output record.
+
+    Exactly one of the two is None: content holds the message text of a successful
+    completion, error_message the provider error rendered like the exception string
+    the synchronous client raises, so `recover_failed_generation` can handle both.
+    """
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    if response.get("status_code") == 200 and body.get("choices"):
+        return body["choices"][0]["message"]["content"], None
+    error = body.get("error") or record.get("error") or {"message": "missing response"}
+    return None, f"Error code: {response.get('status_code')} - {{'error': {error!r}}}"
+
+
+class ProviderBatchBackend:
+    """
+    Run a batch file through the provider's asynchronous batch API (OpenAI and Groq).
+
+    The file is uploaded, a batch job is created for /v1/chat/completions and polled
+    until it finishes, then the output and error files are downloaded.
+
+    Args:
+        client: An `openai.OpenAI` or `groq.Groq` client.
+        poll_interval (float): Seconds between status checks.
+        completion_window (str): Batch completion window requested from the provider.
+    """
+
+    def __init__(self, client, poll_interval=60.0, completion_window="24h"):
+        self.client = client
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def run(self, path):
+        with open(path, "rb") as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+        print(f"Submitted batch {batch.id} for {path}")
+
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+            logging.info(f"Batch {batch.id} status: {batch.status}")
+        if batch.status != "completed":
+            raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+
+        results = {}
+        for file_id in (batch.error_file_id, batch.output_file_id):
+            if file_id:
+                results.update(parse_batch_output(self.client.files.content(file_id).text))
+        return results
+
+
+class LocalBatchBackend:
+    """
+    Run a batch file locally by sending its requests as ordinary chat completions.
+
+    Produces records in the provider batch output format, so it can stand in for
+    `ProviderBatchBackend` in tests, e.g. together with mock_llm_server.py.
+
+    Args:
+        client: An `openai.OpenAI` or `groq.Groq` client.
+        num_workers (int): Number of requests sent concurrently.
+    """
+
+    def __init__(self, client, num_workers=8):
+        self.client = client
+        self.num_workers = num_workers
+
+    def _complete(self, line):
+        request = json.loads(line)
+        try:
+            completion = self.client.chat.completions.create(**request["body"])
+            response = {"status_code": 200, "body": completion.model_dump()}
+        except Exception as e:
+            # Keep the raw error text, which carries Groq's 'failed_generation' payload
+            body = getattr(e, "body", None)
+            error = body.get("error", body) if isinstance(body, dict) else {"message": str(e)}
+            response = {"status_code": getattr(e, "status_code", 500), "body": {"error": error}}
+        return {"custom_id": request["custom_id"], "response": response, "error": None}
+
+    def run(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            records = list(executor.map(self._complete, lines))
+        return {record["custom_id"]: record for record in records}
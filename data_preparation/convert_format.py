@@ -1,5 +1,7 @@
 import pandas as pd
+import numpy as np
 import ast
+import argparse
 
 import sys
 import os
@@ -15,43 +17,65 @@ def parse_args():
         "--input_file",
         type=str,
         default=None,
-        help="Input .csv file")
+        help="Input .csv/.parquet/.arrow file")
     parser.add_argument(
         "--output_file",
         type=str,
         default=None,
-        help="Output .csv file")
+        help="Output .csv/.parquet/.arrow file")
     args = parser.parse_args()
     return args
 
+def convert_record(response_w_corrected_tags, evidence):
+    """
+    Build the training prompt and target completion for one verified row.
+
+    Args:
+        response_w_corrected_tags (str): Passage with corrected error tags.
+        evidence (str): Reference document shown in the prompt.
+
+    Returns:
+        tuple: (prompt, completion)
+    """
+    completion = swap_error_tags(response_w_corrected_tags)
+    errored = remove_error_tags(response_w_corrected_tags)
+    return build_prompt(evidence, errored), completion
+
+def first_documents(documents):
+    """
+    Return the first reference document of every row of a `documents` column.
+
+    Rows share few distinct reference lists, so each distinct value is parsed only once.
+    """
+    documents = documents.astype("category")
+    codes = documents.cat.codes.to_numpy()
+    # Missing documents have code -1, which would index the last parsed value
+    if (codes == -1).any():
+        raise ValueError(f"Rows without documents: {documents.index[codes == -1].tolist()[:10]}")
+    parsed = np.empty(len(documents.cat.categories), dtype=object)
+    parsed[:] = [ast.literal_eval(value)[0] for value in documents.cat.categories]
+    return pd.Series(parsed[codes], index=documents.index)
+
+def convert_columns(responses, documents):
+    """
+    Column-wise version of `convert_record` for a whole table.
+
+    Args:
+        responses (pd.Series): Passages with corrected error tags.
+        documents (pd.Series): Reference document lists as strings.
+
+    Returns:
+        tuple: (prompts, completions) as pd.Series aligned with `responses`
+    """
+    completions = responses.str.replace(SWAP_PATTERN, swap_token, regex=True)
+    errored = responses.map(remove_error_tags)
+    prompts = build_prompt(first_documents(documents), errored)
+    return prompts, completions
+
 if __name__ == "__main__":
     args = parse_args()
-    df = pd.read_csv(args.input_file)
-
-    prompts = []
-    completions = []
-    for i, row in df.iterrows():
-
-        completion = swap_error_tags(row["response_w_corrected_tags"])
-        errored = remove_error_tags(row["response_w_corrected_tags"])
-
-        evidence = ast.literal_eval(row["documents"])[0]
-
-        prompt = "Read the following references:\n"
-        prompt += evidence 
-        prompt += "\nPlease identify all the errors in the following text using the information in the references provided and suggest edits:\nText: "
-        prompt += errored
-
-        prompts.append(prompt)
-        completions.append(completion)
+    df = read_table(args.input_file, columns=["response_w_corrected_tags", "documents"])
 
-    df['prompt'] = prompts
-    df['completion'] = completions 
+    df['prompt'], df['completion'] = convert_columns(df["response_w_corrected_tags"], df["documents"])
     
-    df[['completion', 'prompt']].to_csv(args.output_file)
-
-
-
-
-
-
+    write_table(df[['completion', 'prompt']], args.output_file)
@@ -6,24 +6,88 @@ import json
 import json_repair
 from json_repair import repair_json
 import logging
+import argparse
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from groq import Groq
 from openai import OpenAI
 import sys
 import os
-import tiktoken
 
 # Add the parent directory to sys.path
 parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
 sys.path.append(parent_dir)
 from utils import *
+from llm_cache import LLMCache, CacheMissError
+from batch_mode import write_batch_file, batch_record_content, ProviderBatchBackend, LocalBatchBackend
+from rate_limiter import RateLimiter, PROVIDER_LIMITS, count_message_tokens, count_tokens
 
 # Configure logging to write to a file
 logging.basicConfig(filename='insert_errors.log', 
                     level=logging.ERROR,   # Only log ERROR and higher level messages
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Optional response cache, set up in __main__ when --cache_file is given
+cache = None
+# Request pacing against the provider's per-minute quotas, set up in __main__
+rate_limiter = None
+# Per-thread request counters, see measure_usage
+usage = threading.local()
+
+
+def recover_failed_generation(error):
+    """
+    Recover the generated JSON from a provider error, or re-raise the error.
+
+    Groq rejects outputs that fail its JSON validation but returns the raw generation
+    in a 'failed_generation' field of the error, which is usually repairable.
+    """
+    error_message = str(error)
+    logging.error(f"ERROR CAUGHT: {error_message}")
+
+    if "'failed_generation':" in error_message:
+        try:
+            logging.error("Error message contains 'failed_generation'")
+            # Extract the JSON part using the function
+            result = extract_failed_generation_json(error_message)
+            logging.error(f"Extracted JSON part: {result}")
+        except Exception:  # parse_error
+            logging.error(
+                "An unexpected error occurred while parsing 'failed_generation':"
+            )
+            raise
+    else:
+        logging.error("An unexpected error occurred:")
+        raise error
+    return result
+
+
+def parse_llm_result(result):
+    """Clean and repair a model response and return the JSON string with its 'Edited' value."""
+    # Clean result and attempt to parse the cleaned json
+    result = extract_wrapped_json(result)
+    result = json_repair.repair_json(result)
+    parsed = json.loads(result)
+    return result, parsed["Edited"]
+
 
 def call_llm(client, model_name, messages, temperature, max_tokens):
+    if cache is not None:
+        key = LLMCache.make_key(model_name, messages, temperature, max_tokens)
+        cached = cache.get(key)
+        if cached is not None:
+            return json.loads(cached)["Edited"]
+        if cache.read_only:
+            raise CacheMissError(f"No cached response for request {key} in replay mode")
+
+    # Prompt tokens are counted once per request and reused for pacing and usage accounting
+    prompt_tokens = count_message_tokens(messages)
+    ticket = rate_limiter.acquire(prompt_tokens + max_tokens) if rate_limiter is not None else None
+
+    completion_tokens = None
+    start = time.perf_counter()
     try:
         chat_completion = client.chat.completions.create(
             messages=messages,
@@ -35,34 +99,34 @@ def call_llm(client, model_name, messages, temperature, max_tokens):
 
         # Try to parse the response to ensure it's valid JSON
         result = chat_completion.choices[0].message.content
+        if getattr(chat_completion, "usage", None) is not None:
+            completion_tokens = chat_completion.usage.completion_tokens
     except Exception as e:
-        error_message = str(e)
-        logging.error(f"ERROR CAUGHT: {error_message}")
+        result = recover_failed_generation(e)
 
-        if "'failed_generation':" in error_message:
-            try:
-                logging.error("Error message contains 'failed_generation'")
-                # Extract the JSON part using the function
-                result = extract_failed_generation_json(error_message)
-                logging.error(f"Extracted JSON part: {result}")
-            except Exception:  # parse_error
-                logging.error(
-                    "An unexpected error occurred while parsing 'failed_generation':"
-                )
-                raise
-        else:
-            logging.error("An unexpected error occurred:")
-            raise
+    latency = time.perf_counter() - start
 
-    # Clean result and attempt to parse the cleaned json
-    result = extract_wrapped_json(result)
-    result = json_repair.repair_json(result)
-    result = json.loads(result)
-    return result["Edited"]
+    if completion_tokens is None:
+        completion_tokens = count_tokens(result)
+    if ticket is not None:
+        rate_limiter.settle(ticket, prompt_tokens, completion_tokens)
+    counters = getattr(usage, "counters", None)
+    if counters is not None:
+        counters["requests"] += 1
+        counters["prompt_tokens"] += prompt_tokens
+        counters["completion_tokens"] += completion_tokens
+        counters["latency"] += latency
+
+    result, edited = parse_llm_result(result)
+
+    # Only responses that parsed successfully are cached
+    if cache is not None:
+        cache.put(key, result)
+    return edited
 
 
 ### create numerical errors
-def create_numerical_error(passage, model_name, max_tokens, temperature):
+def numerical_error_messages(passage):
 
     messages=[
                 {"role": "user", "content": "Given a passage with possibly already inserted error tokens wrapped in <temporal>, <entity>, <relation>, "
@@ -104,13 +168,16 @@ def create_numerical_error(passage, model_name, max_tokens, temperature):
                 + "Return valid JSON in the following format:"
                 + "{Edited: paragraph with inserted errors}"}]
 
-    content = call_llm(client, model_name, messages, temperature, max_tokens)
+    return messages
+
 
-    return content
+def create_numerical_error(passage, model_name, max_tokens, temperature):
+    messages = numerical_error_messages(passage)
+    return call_llm(client, model_name, messages, temperature, max_tokens)
 
 
 ### create temporal errors
-def create_temporal_error(passage, model_name, max_tokens, temperature):
+def temporal_error_messages(passage):
 
     messages=[
                 {"role": "user", "content": "Given a passage with possibly already inserted error tokens wrapped in <numerical>, <entity>, <relation>, "
@@ -152,13 +219,16 @@ def create_temporal_error(passage, model_name, max_tokens, temperature):
                 + "Return valid JSON in the following format:"
                 + "{Edited: paragraph with inserted errors}"}]
 
-    content = call_llm(client, model_name, messages, temperature, max_tokens)
+    return messages
+
 
-    return content
+def create_temporal_error(passage, model_name, max_tokens, temperature):
+    messages = temporal_error_messages(passage)
+    return call_llm(client, model_name, messages, temperature, max_tokens)
 
 
 ### create entity errors
-def create_entity_error(passage, model_name, max_tokens, temperature):
+def entity_error_messages(passage):
 
     messages=[
                 {"role": "user", "content": "Given a passage with possibly already inserted error tokens wrapped in <numerical>, <temporal>, <relation>, "
@@ -203,13 +273,16 @@ def create_entity_error(passage, model_name, max_tokens, temperature):
                 + "Return valid JSON in the following format:"
                 + "{Edited: paragraph with inserted errors}"}]
 
-    content = call_llm(client, model_name, messages, temperature, max_tokens)
+    return messages
+
 
-    return content
+def create_entity_error(passage, model_name, max_tokens, temperature):
+    messages = entity_error_messages(passage)
+    return call_llm(client, model_name, messages, temperature, max_tokens)
 
 
 ### create relation errors
-def create_relation_error(passage, model_name, max_tokens, temperature):
+def relation_error_messages(passage):
 
     messages=[
                 {"role": "user", "content": "Given a passage with possibly already inserted error tokens wrapped in <numerical>, <temporal>, <entity>, "
@@ -250,14 +323,16 @@ def create_relation_error(passage, model_name, max_tokens, temperature):
                 + "Return valid JSON in the following format:"
                 + "{Edited:: paragraph with inserted errors}"}]
 
+    return messages
 
-    content = call_llm(client, model_name, messages, temperature, max_tokens)
 
-    return content
+def create_relation_error(passage, model_name, max_tokens, temperature):
+    messages = relation_error_messages(passage)
+    return call_llm(client, model_name, messages, temperature, max_tokens)
 
 
 ### create contradictory errors
-def create_contradictory_error(reference, passage, model_name, max_tokens, temperature):
+def contradictory_error_messages(reference, passage):
 
     messages=[
                 {"role": "user", "content": "Given a reference and a passage with possibly already inserted error "
@@ -330,14 +405,16 @@ def create_contradictory_error(reference, passage, model_name, max_tokens, tempe
                 + "Return valid JSON in the following format:"
                 + "{Edited:: edited passage with contradictory information to reference}"}]
 
+    return messages
 
-    content = call_llm(client, model_name, messages, temperature, max_tokens)
 
-    return content
+def create_contradictory_error(reference, passage, model_name, max_tokens, temperature):
+    messages = contradictory_error_messages(reference, passage)
+    return call_llm(client, model_name, messages, temperature, max_tokens)
 
 
 ### create unverifiable errors
-def create_unverifiable_error(reference, passage, model_name, max_tokens, temperature):
+def unverifiable_error_messages(reference, passage):
 
     messages=[
                 {"role": "user", "content": "Given a reference and a passage with possibly already inserted error tokens wrapped in <numerical>, <temporal>, <entity>, <relation>, or <contradictory>, " 
@@ -381,18 +458,253 @@ def create_unverifiable_error(reference, passage, model_name, max_tokens, temper
                 + "Return valid JSON in the following format:"
                 + "{Edited:: edited passage with contradictory information to reference}"}]
 
+    return messages
 
-    content = call_llm(client, model_name, messages, temperature, max_tokens)
 
-    return content
+def create_unverifiable_error(reference, passage, model_name, max_tokens, temperature):
+    messages = unverifiable_error_messages(reference, passage)
+    return call_llm(client, model_name, messages, temperature, max_tokens)
+
+
+### create multiple errors in one request
+# Definition and examples of each error type, shared by the combined prompt
+ERROR_DEFINITIONS = {
+    "numerical": "numerical errors (<numerical>): an incorrect calculation, estimation, or interpretation of numerical data such as percentages, growth rates, totals, differences, or ratios. "
+                 + "These errors can arise from misapplying formulas, misreading data, rounding incorrectly, or failing to consider time periods or units.\n"
+                 + "Example: Operating expenses increased by <numerical><delete>3.5%</delete><mark>13.5%</mark></numerical> from the previous quarter.\n",
+    "temporal": "temporal errors (<temporal>): incorrect reference or use of figures from the wrong time period. These errors typically "
+                + "arise from misinterpreting the reference's temporal context, such as year-over-year comparisons or quarter-specific data.\n"
+                + "Example: Apple reported record quarterly revenue of $123.9 billion in <temporal><delete>Q1</delete><mark>Q3</mark></temporal> of fiscal year 2022.\n",
+    "entity": "entity errors (<entity>): a small part of a sentence, often an entity (e.g., location name), is "
+              + "incorrect (usually 1-3 words). Entity errors often involve noun phrases or nouns.\n"
+              + "Example: Verizon <entity><delete>Wireless</delete><mark>Media</mark></entity> generated $91.7 billion in operating revenue in 2019.\n",
+    "relation": "relational errors (<relation>): a sentence is partially incorrect as a small part (usually 1 - 3 words). "
+                + "Relational errors often involve verbs and are often the opposite of what it should be.\n"
+                + "Example: The decrease in net sales was <relation><delete>correlated with a drop</delete><mark>caused by an increase</mark></relation> in consumer demand.\n",
+    "contradictory": "contradictory sentence errors (<contradictory>): a sentence where the entire sentence is contradicted "
+                     + "by the given reference, meaning the sentence can be proven false due to a contradiction with information in the reference provided.\n"
+                     + "Example: Reference: In Q4, the firm repaid $500 million of long-term debt ahead of schedule to reduce interest expenses. "
+                     + "Inserted: <contradictory>The firm took on an additional $500 million in long-term debt in Q4 to expand operations.</contradictory>\n",
+    "unverifiable": "unverifiable sentences (<unverifiable>): statements or claims made that cannot be directly confirmed or refuted using the reference. "
+                    + "These errors may not be obviously false, but they introduce information that lacks explicit support or contradiction within the reference.\n"
+                    + "Example: Reference: A company's quarterly filing states that its revenue grew 8% year-over-year due to increased demand in North America. "
+                    + "Inserted: <unverifiable>The company's growth is likely to continue, driven by its strong leadership and innovative culture.</unverifiable>\n",
+}
+
+
+def multiple_errors_messages(reference, passage, selected_tags):
+    """
+    Build one combined few-shot prompt asking for all selected error types at once.
+
+    A tag selected several times (e.g. "relation") is requested that many times.
+    """
+    counts = Counter(selected_tags)
+    definitions = ""
+    for i, (err, n) in enumerate(counts.items()):
+        definitions += f"{i + 1}. {ERROR_DEFINITIONS[err]}"
+    requested = ", ".join(f"{n} <{err}> error" + ("s" if n > 1 else "") for err, n in counts.items())
 
+    messages=[
+                {"role": "user", "content": "Given a reference and a passage, insert errors of the types defined below "
+                + "in the passage, wrapped in tokens to make the passage factually incorrect. "
+                + "The errors are defined as such:\n"
+                + definitions
+                + "Word-level errors (<numerical>, <temporal>, <entity>, <relation>) replace a short span and must be tagged as "
+                + "<type><delete>original text</delete><mark>incorrect text</mark></type>. Sentence-level errors (<contradictory>, <unverifiable>) "
+                + "insert a whole new sentence wrapped in <type></type> tags. Never nest tags inside each other, keep every other part of "
+                + "the passage unchanged, and avoid inserting errors in the first sentence.\n##\n"
+
+                + "Reference: The estimated cost to replace the annuities in 2017 was $179,062, with $144,618 from The Prudential Insurance Company of America.\n"
+                + "Passage: The estimated total cost to replace the annuities the company was liable for in 2017 was $179,062. "
+                + "Of this, $144,618 came from The Prudential Insurance Company of America.\n"
+                + "Errors to insert: 1 <numerical> error, 1 <entity> error, 1 <unverifiable> error\n"
+                + "Edited: The estimated total cost to replace the annuities the company was liable for in 2017 was $179,062. "
+                + "Of this, <numerical><delete>$144,618</delete><mark>$146,507</mark></numerical> came from "
+                + "<entity><delete>The Prudential Insurance Company of America</delete><mark>MetLife</mark></entity>. "
+                + "<unverifiable>The company expects these costs to decline as interest rates rise.</unverifiable>\n##\n"
+
+                + "Reference: The variation between the capital expenditures on a GAAP basis and on a non-GAAP basis in 2014 was $202.9, as expenditures rose from $1682.2 to $1885.1.\n"
+                + "Passage: The capital expenditures on a GAAP basis were $1885.1. The variation between the capital expenditures on a GAAP basis and the one on a non-GAAP basis "
+                + "in the year 2014 was $202.9, which increased the total.\n"
+                + "Errors to insert: 1 <temporal> error, 1 <relation> error, 1 <contradictory> error\n"
+                + "Edited: The capital expenditures on a GAAP basis were $1885.1. The variation between the capital expenditures on a GAAP basis and the one on a non-GAAP basis "
+                + "in the year <temporal><delete>2014</delete><mark>2013</mark></temporal> was $202.9, which <relation><delete>increased</delete><mark>reduced</mark></relation> the total. "
+                + "<contradictory>Capital expenditures on a GAAP basis fell below the non-GAAP amount.</contradictory>\n##\n"
+
+                + "Below is the reference and passage:\n"
+                + "Reference: " + reference + "\n"
+                + "Passage: " + passage + "\n"
+                + "Errors to insert: " + requested + "\n"
+                + "Return valid JSON in the following format:"
+                + "{Edited: passage with all inserted errors}"}]
 
-def get_num_tokens(text):
-    # Choose a tokenizer, e.g., for gpt-3.5 or gpt-4
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return messages
 
-    num_tokens = len(encoding.encode(text))
-    return num_tokens
+
+def create_multiple_errors(reference, passage, selected_tags, model_name, max_tokens, temperature):
+    """
+    Insert all selected error types into a passage with a single LLM request.
+
+    This replaces the chain of `create_*_error` calls with one combined few-shot prompt,
+    so the passage and the instructions are sent once instead of once per error type.
+    """
+    messages = multiple_errors_messages(reference, passage, selected_tags)
+    return call_llm(client, model_name, messages, temperature, max_tokens)
+
+
+def get_num_tokens(text):
+    # Choose a tokenizer, e.g., for gpt-3.5 or gpt-4 (the encoding is cached across calls)
+    return count_tokens(text, "gpt-3.5-turbo")
+
+def measure_usage(fn, *args):
+    """
+    Run `fn(*args)` and return its result along with the LLM requests, prompt and completion
+    tokens and request latency (in seconds) it used on the current thread.
+    """
+    usage.counters = Counter()
+    try:
+        result = fn(*args)
+        return result, usage.counters
+    finally:
+        del usage.counters
+
+def compare_insertion_modes(rows, model_name, max_tokens, temperature):
+    """
+    Run both the chained and the combined insertion mode on the same rows and print
+    their token and latency totals, so the savings of the combined mode can be checked
+    before committing a full run to it. The response cache is bypassed for the comparison.
+
+    Returns:
+        tuple: The usage totals and the edited passages by row position, both keyed by mode.
+    """
+    global cache
+    saved_cache, cache = cache, None
+    totals = {"chained": Counter(), "combined": Counter()}
+    outputs = {"chained": {}, "combined": {}}
+    try:
+        for pos, reference, passage, selected_tags in rows:
+            outputs["chained"][pos], counters = measure_usage(insert_errors, reference, passage, selected_tags, model_name, max_tokens, temperature)
+            totals["chained"].update(counters)
+            outputs["combined"][pos], counters = measure_usage(create_multiple_errors, reference, passage, selected_tags, model_name, max_tokens, temperature)
+            totals["combined"].update(counters)
+    finally:
+        cache = saved_cache
+
+    print(f"Insertion mode comparison on {len(rows)} rows:")
+    for key in ["requests", "prompt_tokens", "completion_tokens", "latency"]:
+        chained, combined = totals["chained"][key], totals["combined"][key]
+        ratio = chained / combined if combined else float("nan")
+        print(f"  {key:<18} chained={chained:>12.1f}  combined={combined:>12.1f}  ratio={ratio:.2f}x")
+    return totals, outputs
+
+# "relation" is listed twice so it is drawn more often
+ERROR_TAGS = ["entity", "numerical", "temporal", "relation", "relation", "contradictory", "unverifiable"]
+
+def select_error_tags(passage):
+    """Randomly pick the error types for a passage, more of them for longer passages."""
+    error_tags = list(ERROR_TAGS)
+    random.shuffle(error_tags)
+    num_tokens = get_num_tokens(passage)
+    if num_tokens<50:
+        N = 1
+    elif num_tokens>=50 and num_tokens<=200:
+        N = 2
+    else:
+        N = 3
+    return error_tags[0:N]
+
+def load_client(model_name, api_key, base_url=None):
+    """Create the API client for a model and return it with its provider name."""
+    if model_name == "gemma2-9b-it":
+        return Groq(api_key=api_key, base_url=base_url, max_retries=5), "groq"
+    return OpenAI(api_key=api_key, base_url=base_url), "openai"
+
+def error_messages(err, reference, passage):
+    """Build the chat messages inserting one error of type `err` into the passage."""
+    if err == "numerical":
+        return numerical_error_messages(passage)
+    elif err == "temporal":
+        return temporal_error_messages(passage)
+    elif err == "entity":
+        return entity_error_messages(passage)
+    elif err == "relation":
+        return relation_error_messages(passage)
+    elif err == "contradictory":
+        return contradictory_error_messages(reference, passage)
+    elif err == "unverifiable":
+        return unverifiable_error_messages(reference, passage)
+    raise ValueError(f"Unknown error type: {err}")
+
+def insert_errors(reference, passage, selected_tags, model_name, max_tokens, temperature):
+    """
+    Insert the selected error types into a passage one after another.
+
+    Each call feeds the previously edited passage into the next one, so the order
+    of `selected_tags` is preserved within a row.
+    """
+    for err in selected_tags: 
+        messages = error_messages(err, reference, passage)
+        passage = call_llm(client, model_name, messages, temperature, max_tokens)
+    return passage
+
+def run_batch_insertion(rows, backend, model_name, max_tokens, temperature, batch_dir, combined=False):
+    """
+    Insert errors for all rows through a batch backend, one batch per round.
+
+    Round k holds the k-th error type of every row that still has one, built on the
+    passage returned by round k-1, so chained error types keep their order. In combined
+    mode there is a single round. Responses go through the same failed_generation
+    recovery and JSON repair as `call_llm`.
+
+    Args:
+        rows (list of tuple): (pos, reference, passage, selected_tags) per row.
+        backend: A `ProviderBatchBackend` or `LocalBatchBackend`.
+        batch_dir (str): Directory for the per-round batch input files.
+        combined (bool): Request all error types of a row in one prompt.
+
+    Returns:
+        dict: Edited passage by row position, for rows that succeeded in every round.
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    references = {pos: reference for pos, reference, _, _ in rows}
+    passages = {pos: passage for pos, _, passage, _ in rows}
+    steps = {pos: [tags] if combined else [[err] for err in tags] for pos, _, _, tags in rows}
+
+    failed = set()
+    round_id = 0
+    while True:
+        pending = [pos for pos in passages if pos not in failed and round_id < len(steps[pos])]
+        if not pending:
+            break
+
+        requests = []
+        for pos in pending:
+            step = steps[pos][round_id]
+            if combined:
+                messages = multiple_errors_messages(references[pos], passages[pos], step)
+            else:
+                messages = error_messages(step[0], references[pos], passages[pos])
+            requests.append((f"row-{pos}", messages))
+        path = os.path.join(batch_dir, f"round_{round_id}.jsonl")
+        write_batch_file(path, requests, model_name, max_tokens, temperature)
+        results = backend.run(path)
+
+        for pos in pending:
+            try:
+                record = results.get(f"row-{pos}")
+                if record is None:
+                    raise RuntimeError("request missing from batch output")
+                content, error_message = batch_record_content(record)
+                if content is None:
+                    content = recover_failed_generation(RuntimeError(error_message))
+                _, passages[pos] = parse_llm_result(content)
+            except Exception as e:
+                logging.error(f"Row {pos} failed in batch round {round_id}: {e}")
+                failed.add(pos)
+        print(f"Batch round {round_id}: {len(pending)} requests, {len(failed)} failed rows so far")
+        round_id += 1
+
+    return {pos: passage for pos, passage in passages.items() if pos not in failed}
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -400,12 +712,12 @@ def parse_args():
         "--input_file",
         type=str,
         default=None,
-        help="Input .csv file to generate training data")
+        help="Input .csv/.parquet/.arrow file to generate training data")
     parser.add_argument(
         "--output_file",
         type=str,
         default=None,
-        help="Output .csv file")
+        help="Output .csv/.parquet/.arrow file")
     parser.add_argument(
         "--model_name",
         type=str,
@@ -426,6 +738,81 @@ def parse_args():
         type=str,
         default=None,
         help="API key for generations")
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="API base URL, e.g. a local mock_llm_server.py for offline runs")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of rows processed concurrently")
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default=None,
+        help="SQLite file caching LLM responses across runs")
+    parser.add_argument(
+        "--cache_max_mb",
+        type=float,
+        default=None,
+        help="evict least recently used responses beyond this cache size")
+    parser.add_argument(
+        "--cache_replay",
+        action="store_true",
+        help="serve responses from the cache only and fail on a miss")
+    parser.add_argument(
+        "--journal_file",
+        type=str,
+        default=None,
+        help="JSONL file recording finished rows (default: output_file + .journal.jsonl)")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip rows already recorded in the journal file")
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="requests per minute limit (default: provider quota, 0 disables)")
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=None,
+        help="tokens per minute limit (default: provider quota, 0 disables)")
+    parser.add_argument(
+        "--insertion_mode",
+        type=str,
+        default="chained",
+        choices=["chained", "combined"],
+        help="chained: one request per error type, combined: all error types in one request")
+    parser.add_argument(
+        "--compare_modes",
+        type=int,
+        default=0,
+        help="run both insertion modes on this many rows first and report their token and latency usage; "
+             "the --insertion_mode outputs of these rows are kept, the other mode's requests are extra cost")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="submit requests through the batch interface instead of per-row chat calls")
+    parser.add_argument(
+        "--batch_backend",
+        type=str,
+        default="provider",
+        choices=["provider", "local"],
+        help="provider: the provider's batch API, local: run batch files with ordinary chat calls (for tests)")
+    parser.add_argument(
+        "--batch_dir",
+        type=str,
+        default=None,
+        help="directory for batch input files (default: output_file + .batch)")
+    parser.add_argument(
+        "--batch_poll_interval",
+        type=float,
+        default=60.0,
+        help="seconds between batch status checks")
     args = parser.parse_args()
     return args
 
@@ -434,52 +821,99 @@ if __name__ == "__main__":
     args = parse_args()
 
     ## Load Data
-    df = pd.read_csv(args.input_file)
+    df = read_table(args.input_file)
 
     ## Load model
-    if args.model_name == "gemma2-9b-it":
-        client = Groq(max_retries=5)
-    else:
-        client = OpenAI()
-
-    client.api_key = args.api_key
-
+    client, provider = load_client(args.model_name, args.api_key, args.base_url)
+
+    limits = PROVIDER_LIMITS[provider]
+    rate_limiter = RateLimiter(
+        rpm=limits["rpm"] if args.rpm is None else args.rpm,
+        tpm=limits["tpm"] if args.tpm is None else args.tpm,
+    )
+
+    if args.cache_file is not None:
+        cache = LLMCache(args.cache_file, max_size_mb=args.cache_max_mb, read_only=args.cache_replay)
+
+    ### Resume from the journal of a previous run
+    journal_file = args.journal_file or args.output_file + ".journal.jsonl"
+    completed = {}
+    if args.resume:
+        for record in read_jsonl(journal_file):
+            completed[record['row']] = record['response_w_tags']
+    # Rewrite the journal so a truncated last line from a crash cannot corrupt new appends
+    rewrite_jsonl(journal_file, [{'row': pos, 'response_w_tags': passage} for pos, passage in completed.items()])
 
     ### Create all errors
-    error_tags = ["entity", "numerical", "temporal", "relation", "relation", "contradictory", "unverifiable"]
-
-    response_w_tags = []
-
-    for i, row in df.iterrows():
+    # Tags are drawn up front so the random stream does not depend on thread scheduling
+    rows = []
+    for pos, (i, row) in enumerate(df.iterrows()):
+        if pos in completed:
+            continue
         
         reference = ast.literal_eval(row['documents'])[0]
         passage = row['response']
-
-        random.shuffle(error_tags)
-        if get_num_tokens(passage)<50:
-            N = 1
-        elif get_num_tokens(passage)>=50 and get_num_tokens(passage)<=200:
-            N = 2
+        selected_tags = select_error_tags(passage)
+        rows.append((pos, reference, passage, selected_tags))
+
+    if args.compare_modes > 0:
+        _, outputs = compare_insertion_modes(rows[:args.compare_modes], args.model_name, args.max_tokens, args.temperature)
+        # The compared rows already have an output of the selected mode, so they are not sent again
+        compared = outputs[args.insertion_mode]
+        append_jsonl(journal_file, [{'row': pos, 'response_w_tags': passage} for pos, passage in sorted(compared.items())])
+        rows = [row for row in rows if row[0] not in compared]
+
+    def process_row(row):
+        pos, reference, passage, selected_tags = row
+        if args.insertion_mode == "combined":
+            return create_multiple_errors(reference, passage, selected_tags, args.model_name, args.max_tokens, args.temperature)
+        return insert_errors(reference, passage, selected_tags, args.model_name, args.max_tokens, args.temperature)
+
+    if args.batch:
+        # One batch per round of error types; rows are journaled once all rounds are merged
+        if args.batch_backend == "provider":
+            backend = ProviderBatchBackend(client, poll_interval=args.batch_poll_interval)
         else:
-            N = 3
-        selected_tags = error_tags[0:N]
-    
-        for err in selected_tags: 
-            if err == "numerical":
-                passage = create_numerical_error(passage, args.model_name, args.max_tokens, args.temperature)
-            elif err == "temporal":
-                passage = create_temporal_error(passage, args.model_name, args.max_tokens, args.temperature)
-            elif err == "entity":
-                passage = create_entity_error(passage, args.model_name, args.max_tokens, args.temperature)
-            elif err == "relation":
-                passage = create_relation_error(passage, args.model_name, args.max_tokens, args.temperature)
-            elif err == "contradictory":
-                passage = create_contradictory_error(reference, passage, args.model_name, args.max_tokens, args.temperature)
-            elif err == "unverifiable":
-                passage = create_unverifiable_error(reference, passage, args.model_name, args.max_tokens, args.temperature)
-
-        response_w_tags.append(passage)
-
-
-    df['response_w_tags'] = response_w_tags
-    df.to_csv(args.output_file)
+            backend = LocalBatchBackend(client, num_workers=args.num_workers)
+        batch_dir = args.batch_dir or args.output_file + ".batch"
+        edited = run_batch_insertion(rows, backend, args.model_name, args.max_tokens, args.temperature,
+                                     batch_dir, combined=args.insertion_mode == "combined")
+        append_jsonl(journal_file, [{'row': pos, 'response_w_tags': passage} for pos, passage in sorted(edited.items())])
+    else:
+        # Rows run concurrently, but each row's chain of errors stays sequential.
+        # Finished rows are journaled as soon as they complete; a failed row is logged and
+        # left out of the journal, so --resume retries it.
+        executor = ThreadPoolExecutor(max_workers=args.num_workers)
+        futures = {executor.submit(process_row, row): row[0] for row in rows}
+        failed = 0
+        try:
+            for future in as_completed(futures):
+                pos = futures[future]
+                try:
+                    passage = future.result()
+                except Exception as e:
+                    logging.error(f"Row {pos} failed: {e}")
+                    failed += 1
+                    continue
+                append_jsonl(journal_file, [{'row': pos, 'response_w_tags': passage}])
+        finally:
+            # On an interrupt, drop queued rows instead of waiting for the whole dataset
+            # (shutdown(cancel_futures=True) needs Python 3.9)
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        if failed:
+            print(f"{failed} of {len(rows)} rows failed")
+
+    ### Build the output from the journal, in input row order
+    completed = {record['row']: record['response_w_tags'] for record in read_jsonl(journal_file)}
+    missing = [pos for pos in range(len(df)) if pos not in completed]
+    if missing:
+        sys.exit(f"{len(missing)} rows failed (see insert_errors.log); rerun with --resume to retry them")
+    df['response_w_tags'] = [completed[pos] for pos in range(len(df))]
+    write_table(df, args.output_file)
+
+    print(f"LLM usage: {rate_limiter.stats()}")
+    if cache is not None:
+        print(f"LLM cache: {cache.stats()}")
+        cache.close()
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class CacheMissError(KeyError):
+    """Raised in replay mode when a request has no cached response."""
+
+
+class LLMCache:
+    """
+    Disk-backed, content-addressed cache for LLM responses.
+
+    Responses are stored in a SQLite file keyed on a SHA-256 hash of the model name,
+    messages, temperature and max_tokens, so any change to a prompt produces a new key
+    while untouched prompts are served from disk. When `max_size_mb` is set, the least
+    recently used entries are evicted once the stored responses exceed that size.
+    With `read_only=True` the cache never writes, which is used to replay a previous run.
+
+    Args:
+        path (str): Path of the SQLite file (created if missing).
+        max_size_mb (float, optional): Upper bound on the total size of stored responses.
+        read_only (bool): Serve from the cache only, never store new responses.
+
+    Example:
+        >>> cache = LLMCache("llm_cache.sqlite", max_size_mb=512)
+        >>> key = LLMCache.make_key("gemma2-9b-it", messages, 0.3, 512)
+        >>> cache.get(key) is None
+        True
+        >>> cache.put(key, '{"Edited": "..."}')
+    """
+
+    def __init__(self, path, max_size_mb=None, read_only=False):
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        # The connection is shared by the worker threads of insert_errors.py
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_name, messages, temperature, max_tokens):
+        payload = json.dumps(
+            {"model": model_name, "messages": messages, "temperature": temperature, "max_tokens": int(max_tokens)},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key, value):
+        if self.read_only:
+            return
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._size += size - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache fits, always keeping the newest one
+        if self.max_bytes is None:
+            return
+        while self._size > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if len(rows) <= 1:
+                break
+            for key, size in rows[:-1]:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                self.evictions += 1
+                if self._size <= self.max_bytes:
+                    break
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_mb": self._size / (1024 * 1024),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
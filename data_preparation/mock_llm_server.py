@@ -0,0 +1,281 @@
+"""
+Offline stand-in for the Groq/OpenAI chat completions API used by insert_errors.py.
+
+The server answers every `.../chat/completions` request with a rule-generated
+`{"Edited": ...}` JSON object, so the generation pipeline can be benchmarked and
+regression-tested without network access or API costs. Latency, transient server
+errors and Groq-style `failed_generation` errors can be injected to exercise the
+retry and JSON-recovery paths of `call_llm`.
+
+Usage:
+    python mock_llm_server.py --port 8000 --latency_ms 800 --error_rate 0.05 --failed_generation_rate 0.1
+    python insert_errors.py ... --base_url http://localhost:8000 --rpm 0 --tpm 0            # Groq client
+    python insert_errors.py ... --model_name gpt-4o --base_url http://localhost:8000/v1 --rpm 0 --tpm 0   # OpenAI client
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ERROR_TYPES = ["numerical", "temporal", "entity", "relation", "contradictory", "unverifiable"]
+
+# Already tagged regions are left untouched, like the prompts ask the real models to do
+TAGGED_SPAN = re.compile(r"<(" + "|".join(ERROR_TYPES) + r")>.*?</\1>", re.DOTALL)
+# A number never ends on a comma, so the year in "In 2019, ..." is still recognized as a year
+NUMBER = re.compile(r"\$?\d(?:[\d,]*\d)?(?:\.\d+)?%?")
+YEAR = re.compile(r"\b(?:19|20)\d{2}\b")
+CAPITALIZED = re.compile(r"(?<=[a-z,] )[A-Z][a-zA-Z]+")
+RELATIONS = {
+    "increased": "decreased", "decreased": "increased", "increase": "decrease", "decrease": "increase",
+    "rose": "fell", "fell": "rose", "higher": "lower", "lower": "higher", "more": "less", "less": "more",
+    "divide": "multiply", "multiply": "divide", "gain": "loss", "loss": "gain",
+}
+RELATION = re.compile(r"\b(" + "|".join(RELATIONS) + r")\b")
+SENTENCES = {
+    "contradictory": "The figures above were not reported in the referenced filing.",
+    "unverifiable": "Analysts expect this trend to continue over the next few years.",
+}
+
+
+def extract_passage(prompt):
+    """Return the passage to edit, i.e. the last `Paragraph:`/`Passage:` section of the prompt."""
+    start = max(prompt.rfind("Paragraph: "), prompt.rfind("Passage: "))
+    if start == -1:
+        return ""
+    passage = prompt[start:].split(": ", 1)[1]
+    for marker in ["\nErrors to insert:", "\nReturn valid JSON"]:
+        passage = passage.split(marker, 1)[0]
+    return passage
+
+
+def requested_error_types(prompt):
+    """Return the error types asked for by a chained (`Now, insert ...`) or combined prompt."""
+    match = re.search(r"Errors to insert: ([^\n]*)\nReturn valid JSON", prompt)
+    if match:
+        return re.findall(r"\d+ <(\w+)> error", match.group(1))
+    match = re.search(r"Now, insert (\w+)", prompt)
+    if match and match.group(1) in ERROR_TYPES:
+        return [match.group(1)]
+    return ["numerical"]
+
+
+def perturb_number(text):
+    # Bump the last digit so the value stays well-formed
+    digits = [i for i, c in enumerate(text) if c.isdigit()]
+    i = digits[-1]
+    return text[:i] + str((int(text[i]) + 3) % 10) + text[i + 1:]
+
+
+def insert_error(passage, err):
+    """Insert one error of type `err` outside the already tagged spans of the passage."""
+    if err in SENTENCES:
+        return passage.rstrip() + f" <{err}>{SENTENCES[err]}</{err}>"
+
+    if err == "numerical":
+        pattern, edit = NUMBER, perturb_number
+    elif err == "temporal":
+        pattern, edit = YEAR, lambda year: str(int(year) - 1)
+    elif err == "entity":
+        pattern, edit = CAPITALIZED, lambda word: "Globex" if word == "Acme" else "Acme"
+    else:
+        pattern, edit = RELATION, lambda word: RELATIONS[word]
+
+    # Walk the untagged gaps between existing tagged spans
+    gaps, last = [], 0
+    for match in TAGGED_SPAN.finditer(passage):
+        gaps.append((last, match.start()))
+        last = match.end()
+    gaps.append((last, len(passage)))
+
+    for start, end in gaps:
+        for match in pattern.finditer(passage, start, end):
+            original = match.group(0)
+            # Standalone years are temporal, not numerical
+            if err == "numerical" and YEAR.fullmatch(original):
+                continue
+            tagged = f"<{err}><delete>{original}</delete><mark>{edit(original)}</mark></{err}>"
+            return passage[:match.start()] + tagged + passage[match.end():]
+    return passage
+
+
+def generate_edit(prompt):
+    passage = extract_passage(prompt)
+    for err in requested_error_types(prompt):
+        passage = insert_error(passage, err)
+    return passage
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server answering chat completion requests with rule-generated edits.
+
+    Args:
+        address (tuple): (host, port) to bind.
+        latency_ms (float): Mean response latency in milliseconds.
+        latency_jitter_ms (float): Uniform jitter added to or removed from the latency.
+        error_rate (float): Fraction of requests answered with a retryable 503 error.
+        failed_generation_rate (float): Fraction of requests answered with a Groq-style 400
+            `json_validate_failed` error carrying the edit in `failed_generation`.
+        seed (int, optional): Seed for the injected latency and errors.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=0.0, latency_jitter_ms=0.0, error_rate=0.0,
+                 failed_generation_rate=0.0, seed=None):
+        super().__init__(address, MockLLMHandler)
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.failed_generation_rate = failed_generation_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "completions": 0, "errors": 0, "failed_generations": 0}
+
+    def draw(self):
+        """Draw the latency and the outcome of one request."""
+        with self.lock:
+            latency = self.latency_ms + self.random.uniform(-self.latency_jitter_ms, self.latency_jitter_ms)
+            roll = self.random.random()
+        if roll < self.error_rate:
+            outcome = "errors"
+        elif roll < self.error_rate + self.failed_generation_rate:
+            outcome = "failed_generations"
+        else:
+            outcome = "completions"
+        return max(latency, 0.0) / 1000.0, outcome
+
+    def count(self, key):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts[key] += 1
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            with self.server.lock:
+                self.send_json(200, dict(self.server.counts))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        latency, outcome = self.server.draw()
+        time.sleep(latency)
+        self.server.count(outcome)
+
+        prompt = request["messages"][-1]["content"]
+        content = json.dumps({"Edited": generate_edit(prompt)})
+        if outcome == "errors":
+            self.send_json(503, {"error": {"message": "Service unavailable (injected)", "type": "server_error"}})
+        elif outcome == "failed_generations":
+            # Groq returns the raw generation when its JSON validation fails; drop the closing
+            # brace so the JSON-repair path in extract_failed_generation_json is exercised
+            self.send_json(400, {"error": {
+                "message": "Failed to generate JSON. Please adjust your prompt. See 'failed_generation' for more details.",
+                "type": "invalid_request_error",
+                "code": "json_validate_failed",
+                "failed_generation": content[:-1],
+            }})
+        else:
+            prompt_tokens = sum(len(m["content"].split()) for m in request["messages"])
+            completion_tokens = len(content.split())
+            self.send_json(200, {
+                "id": f"chatcmpl-mock-{self.server.counts['requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            })
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="host to bind")
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="port to bind")
+    parser.add_argument(
+        "--latency_ms",
+        type=float,
+        default=0.0,
+        help="mean response latency in milliseconds")
+    parser.add_argument(
+        "--latency_jitter_ms",
+        type=float,
+        default=0.0,
+        help="uniform jitter around the mean latency in milliseconds")
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests failing with a retryable 503")
+    parser.add_argument(
+        "--failed_generation_rate",
+        type=float,
+        default=0.0,
+        help="fraction of requests failing with a 'failed_generation' payload")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="random seed for injected latency and errors")
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    server = MockLLMServer(
+        (args.host, args.port),
+        latency_ms=args.latency_ms,
+        latency_jitter_ms=args.latency_jitter_ms,
+        error_rate=args.error_rate,
+        failed_generation_rate=args.failed_generation_rate,
+        seed=args.seed,
+    )
+    print(f"Mock LLM server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Mock LLM server stats: {server.counts}")
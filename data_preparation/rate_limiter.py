@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+import tiktoken
+
+# Default per-minute quotas, kept slightly under the published account limits
+PROVIDER_LIMITS = {
+    "groq": {"rpm": 28, "tpm": 14000},
+    "openai": {"rpm": 480, "tpm": 190000},
+}
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name="gpt-3.5-turbo"):
+    """Return the tiktoken encoding for a model, built once per process."""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        # Non-OpenAI models (e.g. gemma2-9b-it on Groq) fall back to a close approximation
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text, model_name="gpt-3.5-turbo"):
+    return len(get_encoding(model_name).encode(text))
+
+
+def count_message_tokens(messages, model_name="gpt-3.5-turbo"):
+    """
+    Count the prompt tokens of a chat request.
+
+    Uses the OpenAI chat accounting of a few extra tokens per message for the role
+    and separators, which is close enough for budgeting other providers too.
+    """
+    num_tokens = 3
+    for message in messages:
+        num_tokens += 4 + count_tokens(message["content"], model_name)
+    return num_tokens
+
+
+class RateLimiter:
+    """
+    Thread-safe pacing of requests against requests-per-minute and tokens-per-minute limits.
+
+    Every request reserves its prompt tokens plus max_tokens before it is sent, and the
+    reservation is corrected to the actual prompt + completion tokens once the response
+    arrives. Requests block until both budgets of the sliding one-minute window allow them,
+    so the provider never has to reject them with a 429.
+
+    Args:
+        rpm (int, optional): Requests per minute; None or 0 disables the request limit.
+        tpm (int, optional): Tokens per minute; None or 0 disables the token limit.
+        window (float): Length of the sliding window in seconds.
+
+    Example:
+        >>> limiter = RateLimiter(rpm=30, tpm=15000)
+        >>> ticket = limiter.acquire(prompt_tokens + max_tokens)
+        >>> # ... send the request ...
+        >>> limiter.settle(ticket, prompt_tokens, completion_tokens)
+    """
+
+    def __init__(self, rpm=None, tpm=None, window=60.0):
+        self.rpm = rpm or None
+        self.tpm = tpm or None
+        self.window = window
+        self._entries = deque()
+        self._window_tokens = 0
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.wait_seconds = 0.0
+
+    def _purge(self, now):
+        while self._entries and self._entries[0][0] <= now - self.window:
+            _, tokens = self._entries.popleft()
+            self._window_tokens -= tokens
+
+    def acquire(self, tokens):
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._purge(now)
+                fits_requests = self.rpm is None or len(self._entries) < self.rpm
+                # A single request larger than the whole budget is let through on an empty window
+                fits_tokens = (self.tpm is None or not self._entries
+                               or self._window_tokens + tokens <= self.tpm)
+                if fits_requests and fits_tokens:
+                    entry = [now, tokens]
+                    self._entries.append(entry)
+                    self._window_tokens += tokens
+                    self.requests += 1
+                    self.wait_seconds += now - start
+                    return entry
+                wait = self._entries[0][0] + self.window - now
+            # Wake up periodically since settled reservations can free budget early
+            time.sleep(min(max(wait, 0.01), 1.0))
+
+    def settle(self, ticket, prompt_tokens, completion_tokens):
+        with self._lock:
+            actual = prompt_tokens + completion_tokens
+            # The entry may already have left the window, in which case only the totals change
+            if any(entry is ticket for entry in self._entries):
+                self._window_tokens += actual - ticket[1]
+                ticket[1] = actual
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "wait_seconds": round(self.wait_seconds, 2),
+            }
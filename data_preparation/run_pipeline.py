@@ -0,0 +1,252 @@
+import pandas as pd
+import ast
+import argparse
+import csv
+import logging
+import sys
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import *
+import insert_errors
+from llm_cache import LLMCache
+from rate_limiter import RateLimiter, PROVIDER_LIMITS
+from verify_responses import is_context_relevant, verify_record, FilterStats
+from convert_format import convert_record
+from span_classifier import shared_classifier
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        default=None,
+        help="Input .csv/.parquet/.arrow file to generate training data")
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help="Output .csv/.parquet/.arrow file with prompt and completion columns")
+    parser.add_argument(
+        "--model_name",
+        type=str,
+        default="gemma2-9b-it",
+        help="model name for generations")
+    parser.add_argument(
+        "--max_tokens",
+        type=int,
+        default=512,
+        help="max_token for model")
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        default=0.3,
+        help="temperature for model")
+    parser.add_argument(
+        "--api_key",
+        type=str,
+        default=None,
+        help="API key for generations")
+    parser.add_argument(
+        "--base_url",
+        type=str,
+        default=None,
+        help="API base URL, e.g. a local mock_llm_server.py for offline runs")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="number of rows processed concurrently")
+    parser.add_argument(
+        "--insertion_mode",
+        type=str,
+        default="chained",
+        choices=["chained", "combined"],
+        help="chained: one request per error type, combined: all error types in one request")
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="requests per minute limit (default: provider quota, 0 disables)")
+    parser.add_argument(
+        "--tpm",
+        type=int,
+        default=None,
+        help="tokens per minute limit (default: provider quota, 0 disables)")
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default=None,
+        help="SQLite file caching LLM responses across runs")
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1000,
+        help="number of rows read, and for Parquet/Arrow output written, at a time")
+    args = parser.parse_args()
+    return args
+
+
+### Stages
+# Each stage takes and yields record dicts, so rows flow through the whole pipeline one
+# by one and only a bounded number of them is held in memory at any time.
+
+# Input columns used by the pipeline; other columns are never parsed
+INPUT_COLUMNS = ["documents", "response"]
+
+def read_records(input_file, chunk_size, counts):
+    for chunk in iter_table(input_file, chunk_size, columns=INPUT_COLUMNS):
+        for record in chunk.to_dict("records"):
+            record["row"] = counts["read"]
+            counts["read"] += 1
+            yield record
+
+
+def filter_irrelevant(records, counts, stats):
+    # Context relevancy only depends on the original response, so rows failing it are
+    # dropped before paying for error insertion
+    for record in records:
+        start = time.perf_counter()
+        relevant = is_context_relevant(record["response"])
+        stats.seconds["context_relevancy"] += time.perf_counter() - start
+        stats.evaluated["context_relevancy"] += 1
+        stats.rejected["context_relevancy"] += int(not relevant)
+        if relevant:
+            yield record
+        else:
+            counts["dropped_context_relevancy"] += 1
+
+
+def ordered_concurrent_map(fn, items, num_workers):
+    """Apply fn to items on a thread pool, yielding results in input order with a bounded window."""
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        window = deque()
+        for item in items:
+            window.append(executor.submit(fn, item))
+            if len(window) >= 2 * num_workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
+
+
+def insert_stage(records, args):
+    def insert(record):
+        record["reference"] = ast.literal_eval(record["documents"])[0]
+        selected_tags = record["selected_tags"]
+        try:
+            if args.insertion_mode == "combined":
+                record["response_w_tags"] = insert_errors.create_multiple_errors(
+                    record["reference"], record["response"], selected_tags, args.model_name, args.max_tokens, args.temperature)
+            else:
+                record["response_w_tags"] = insert_errors.insert_errors(
+                    record["reference"], record["response"], selected_tags, args.model_name, args.max_tokens, args.temperature)
+        except Exception as e:
+            # A single failed row should not stop a long streaming run
+            logging.error(f"Row {record['row']} failed during error insertion: {e}")
+            record["response_w_tags"] = None
+        return record
+
+    def draw_tags(records):
+        # Tags are drawn here, in input order on the consuming thread, so the random
+        # stream does not depend on thread scheduling
+        for record in records:
+            record["selected_tags"] = insert_errors.select_error_tags(record["response"])
+            yield record
+
+    return ordered_concurrent_map(insert, draw_tags(records), args.num_workers)
+
+
+def verify_stage(records, counts, stats):
+    for record in records:
+        if record["response_w_tags"] is None:
+            counts["failed_insertion"] += 1
+            continue
+        # Context relevancy was already checked by filter_irrelevant
+        corrected = verify_record(record["response"], record["response_w_tags"], stats, skip=["context_relevancy"])
+        if corrected is None:
+            counts["dropped_verification"] += 1
+            continue
+        record["response_w_corrected_tags"] = corrected
+        yield record
+
+
+def convert_stage(records):
+    for record in records:
+        record["prompt"], record["completion"] = convert_record(record["response_w_corrected_tags"], record["reference"])
+        yield record
+
+
+def write_records(records, output_file, chunk_size, counts):
+    if get_table_format(output_file) == "csv":
+        # Same layout as convert_format.py; every row is flushed so it is on disk immediately
+        with open(output_file, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["", "completion", "prompt"])
+            for record in records:
+                writer.writerow([record["row"], record["completion"], record["prompt"]])
+                f.flush()
+                counts["written"] += 1
+        return
+
+    # Columnar output is written as one row group (Parquet) or record batch (Arrow) per chunk
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([("row", pa.int64()), ("completion", pa.string()), ("prompt", pa.string())])
+    if get_table_format(output_file) == "parquet":
+        writer = pq.ParquetWriter(output_file, schema)
+    else:
+        writer = pa.ipc.new_file(output_file, schema)
+
+    buffer = []
+    def flush():
+        writer.write_table(pa.Table.from_pylist(buffer, schema=schema))
+        counts["written"] += len(buffer)
+        buffer.clear()
+
+    try:
+        for record in records:
+            buffer.append({"row": record["row"], "completion": record["completion"], "prompt": record["prompt"]})
+            if len(buffer) >= chunk_size:
+                flush()
+        if buffer:
+            flush()
+    finally:
+        writer.close()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    ## Load model
+    insert_errors.client, provider = insert_errors.load_client(args.model_name, args.api_key, args.base_url)
+    limits = PROVIDER_LIMITS[provider]
+    insert_errors.rate_limiter = RateLimiter(
+        rpm=limits["rpm"] if args.rpm is None else args.rpm,
+        tpm=limits["tpm"] if args.tpm is None else args.tpm,
+    )
+    if args.cache_file is not None:
+        insert_errors.cache = LLMCache(args.cache_file)
+
+    ## Run insert -> verify -> filter -> convert as one stream
+    counts = Counter()
+    filter_stats = FilterStats()
+    records = read_records(args.input_file, args.chunk_size, counts)
+    records = filter_irrelevant(records, counts, filter_stats)
+    records = insert_stage(records, args)
+    records = verify_stage(records, counts, filter_stats)
+    records = convert_stage(records)
+    write_records(records, args.output_file, args.chunk_size, counts)
+
+    print(f"Pipeline: {dict(counts)}")
+    print(filter_stats.summary().to_string())
+    print(f"Span classifier: {shared_classifier.stats()}")
+    print(f"LLM usage: {insert_errors.rate_limiter.stats()}")
+    if insert_errors.cache is not None:
+        print(f"LLM cache: {insert_errors.cache.stats()}")
+        insert_errors.cache.close()
@@ -1,11 +1,15 @@
 import pandas as pd
+import argparse
 import sys
 import os
+import time
+from collections import Counter
 
 # Add the parent directory to sys.path
 parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
 sys.path.append(parent_dir)
 from utils import *
+from span_classifier import SpanClassifier, correct_tags
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -13,125 +17,175 @@ def parse_args():
         "--input_file",
         type=str,
         default=None,
-        help="Input .csv file")
+        help="Input .csv/.parquet/.arrow file")
     parser.add_argument(
         "--output_file",
         type=str,
         default=None,
-        help="Output .csv file")
+        help="Output .csv/.parquet/.arrow file")
+    parser.add_argument(
+        "--summary_file",
+        type=str,
+        default=None,
+        help="Optional .csv/.parquet/.arrow file for per-check rejection counts and timings")
+    parser.add_argument(
+        "--span_cache_file",
+        type=str,
+        default=None,
+        help="Optional JSON file persisting span classifications across runs and stages")
     args = parser.parse_args()
     return args
 
-def correct_tags(text):
-    """
-    Corrects tag types in a given annotated text based on whether content is numerical, temporal, or relation.
-    """
+# Phrases showing the response could not be grounded in the context
+IRRELEVANT_CONTEXT_PHRASES = ["not specified in the provided context",
+                              "not explicitly mentioned in the given context",
+                              "not explicitly mentioned in the provided context",
+                              "not provided in this information",
+                              "is not provided", 
+                              "context does not provide"]
 
-    def correct_tag_type(old_tag, delete_val, mark_val):
-        """Determine the appropriate tag based on delete/mark values."""
-        if is_temporal(delete_val) and is_temporal(mark_val):
-            return "temporal"
-        elif is_numerical(delete_val) and is_numerical(mark_val):
-            return "numerical"
-        elif contains_only_nouns_or_phrases(delete_val) and contains_only_nouns_or_phrases(mark_val):
-            return "entity"  
-        elif contains_only_verbs_adj_adv(delete_val) and contains_only_verbs_adj_adv(mark_val):
-            return "relation" 
-        else:
-            return old_tag 
-    pattern = re.compile(r"<(entity|temporal|numerical|relation)><delete>(.*?)</delete><mark>(.*?)</mark></\1>", re.DOTALL)
+NESTING_TAGS = ["temporal", "numerical", "entity", "relation", "contradictory", "unverifiable"]
 
-    def replacer(match):
-        old_tag = match.group(1)
-        delete_val = match.group(2).strip()
-        mark_val = match.group(3).strip()
 
-        new_tag = correct_tag_type(old_tag, delete_val, mark_val)
-        return f"<{new_tag}><delete>{delete_val}</delete><mark>{mark_val}</mark></{new_tag}>"
+def is_context_relevant(response):
+    """Check that the original response does not state the context lacks the answer."""
+    return not any(keyword in response for keyword in IRRELEVANT_CONTEXT_PHRASES)
 
-    return pattern.sub(replacer, text)
 
+def is_type_consistent(response_w_tags):
+    """Check that every deleted/marked pair is of the same temporal and numerical type."""
+    pattern = r"<delete>(.*?)</delete><mark>(.*?)</mark>"
+    matches = re.findall(pattern, response_w_tags, re.DOTALL)
 
-if __name__ == "__main__":
-    args = parse_args()
-    
-    ### Load data
-    df = pd.read_csv(args.input_file)
+    for delete_text, mark_text in matches:
+        if is_temporal(delete_text) != is_temporal(mark_text):
+            return False
 
-    ### I. Check context provides relevant information
-    lst = ["not specified in the provided context",
-            "not explicitly mentioned in the given context",
-            "not explicitly mentioned in the provided context",
-            "not provided in this information",
-            "is not provided", 
-            "context does not provide"]
+        if is_numerical(delete_text) != is_numerical(mark_text):
+            return False
+    return True
 
-    results = []
-    for i, row in df.iterrows():
-        if any(keyword in row['response'] for keyword in lst):
-            results.append(False)
 
-        else:
-            results.append(True)
+def is_recoverable(response, response_w_tags):
+    """Check that removing the inserted errors gives back the original response."""
+    s = recover_original_string(response_w_tags)
+    return have_same_word_sequence(response, s)
 
-    df['context_relevancy'] = results
-    df = df[df['context_relevancy']==True]
-    df = df.drop(columns=['context_relevancy'])
 
-    ### II. Check nested error tags
+def has_no_nested_tags(response_w_tags):
+    return not contain_nested_tags(NESTING_TAGS, response_w_tags)
 
-    tags = ["temporal", "numerical", "entity", "relation", "contradictory", "unverifiable"]
-    results = []
-    for i, row in df.iterrows():
-        s = contain_nested_tags(tags, row['response_w_tags'])
-        results.append(s)
 
-    df['contain_nested_tags'] = results
-    df = df[df['contain_nested_tags']==False]
-    df = df.drop(columns=['contain_nested_tags'])
+# Checks in the order they are applied; each takes (response, response_w_tags)
+FILTERS = [
+    ("context_relevancy", lambda response, response_w_tags: is_context_relevant(response)),
+    ("nested_tags", lambda response, response_w_tags: has_no_nested_tags(response_w_tags)),
+    ("type_consistency", lambda response, response_w_tags: is_type_consistent(response_w_tags)),
+    ("recoverability", is_recoverable),
+]
 
-    ### III. Check if type of mark_text and delete_text is consistent
-    results = []
-    for i, row in df.iterrows():
 
-        bConsist = True
+class FilterStats:
+    """
+    Per-check counters of a verification run.
 
-        pattern = r"<delete>(.*?)</delete><mark>(.*?)</mark>"
-        matches = re.findall(pattern, row['response_w_tags'], re.DOTALL)
+    For every filter (and the final tag correction) it records how many rows were
+    evaluated, how many were rejected and the total time spent, so the most expensive
+    and the most selective checks can be identified.
+    """
 
-        for delete_text, mark_text in matches:
-            if is_temporal(delete_text) != is_temporal(mark_text):
-                bConsist = False
-                break
+    def __init__(self):
+        self.evaluated = Counter()
+        self.rejected = Counter()
+        self.seconds = Counter()
 
-            if is_numerical(delete_text) != is_numerical(mark_text):
-                bConsist = False
-                break
+    def summary(self):
+        names = [name for name, _ in FILTERS] + ["tag_correction"]
+        df = pd.DataFrame({
+            "evaluated": [self.evaluated[name] for name in names],
+            "rejected": [self.rejected[name] for name in names],
+            "seconds": [self.seconds[name] for name in names],
+        }, index=names)
+        df["rejection_rate"] = df["rejected"] / df["evaluated"].where(df["evaluated"] > 0)
+        df["ms_per_row"] = 1000 * df["seconds"] / df["evaluated"].where(df["evaluated"] > 0)
+        return df
 
-        results.append(bConsist)
 
-    df['type_consistent'] = results
-    df = df[df['type_consistent']==True]
-    df = df.drop(columns=['type_consistent'])
+def passes_filters(response, response_w_tags, stats=None, skip=()):
+    """
+    Apply all filters to a single generated row, stopping at the first failing check.
 
-    ### IV. Check if original can be recovered
+    Args:
+        response (str): Original response.
+        response_w_tags (str): Response with inserted error tags.
+        stats (FilterStats, optional): Receives per-check rejection counts and timings.
+        skip (collection of str): Names of checks already applied upstream.
 
-    results = []
-    for i, row in df.iterrows():
-        s = recover_original_string(row['response_w_tags'])
-        results.append(have_same_word_sequence(row['response'], s))
+    Returns:
+        bool: True if the row passes every check.
+    """
+    for name, check in FILTERS:
+        if name in skip:
+            continue
+        start = time.perf_counter()
+        passed = check(response, response_w_tags)
+        if stats is not None:
+            stats.seconds[name] += time.perf_counter() - start
+            stats.evaluated[name] += 1
+            stats.rejected[name] += int(not passed)
+        if not passed:
+            return False
+    return True
+
+
+def verify_record(response, response_w_tags, stats=None, skip=()):
+    """
+    Filter and correct a single generated row.
 
-    df['insertion_succeed'] = results
-    df = df[df['insertion_succeed']==True]
-    df = df.drop(columns=['insertion_succeed'])
+    `skip` names checks of `FILTERS` already applied upstream, see `passes_filters`.
 
-    ### V. Correcting tags
-    results = []
-   
-    for i, row in df.iterrows():
-        s = correct_tags(row['response_w_tags'])
-        results.append(s)
+    Returns:
+        str or None: The passage with corrected tags, or None if the row is filtered out.
+    """
+    if not passes_filters(response, response_w_tags, stats, skip):
+        return None
 
-    df['response_w_corrected_tags'] = results
-    df.to_csv(args.output_file)
+    start = time.perf_counter()
+    corrected = correct_tags(response_w_tags)
+    if stats is not None:
+        stats.seconds["tag_correction"] += time.perf_counter() - start
+        stats.evaluated["tag_correction"] += 1
+    return corrected
 
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    ### Load data
+    df = read_table(args.input_file)
+    num_rows = len(df)
+
+    ### Filter every row in a single pass
+    # I. context relevancy, II. nested tags, III. type consistency, IV. recoverability
+    stats = FilterStats()
+    keep = [passes_filters(response, response_w_tags, stats)
+            for response, response_w_tags in zip(df['response'], df['response_w_tags'])]
+    df = df[keep].copy()
+
+    ### V. Correcting tags, with the POS analysis of all spans batched into one spaCy run
+    start = time.perf_counter()
+    classifier = SpanClassifier(cache_file=args.span_cache_file)
+    classifier.prime(collect_tag_spans(df['response_w_tags']))
+    df['response_w_corrected_tags'] = [correct_tags(text, classifier) for text in df['response_w_tags']]
+    stats.seconds["tag_correction"] += time.perf_counter() - start
+    stats.evaluated["tag_correction"] += len(df)
+
+    write_table(df, args.output_file)
+
+    summary = stats.summary()
+    print(f"Kept {len(df)} of {num_rows} rows")
+    print(summary.to_string())
+    print(f"Span classifier: {classifier.stats()}")
+    classifier.save()
+    if args.summary_file is not None:
+        write_table(summary, args.summary_file)
@@ -1,6 +1,21 @@
 import streamlit as st
 import pandas as pd
 import re
+import json
+import html
+import hashlib
+import queue
+import sys
+import os
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from tag_parser import close_open_tags
 
 st.set_page_config(page_title="Fine-grained Hallucination Detection", layout="wide")
 
@@ -53,32 +68,199 @@ st.markdown("""
 
 # Process the edited output to apply styling
 def process_edited_text(text):
+    # Model output is escaped first, so only the known tags below become HTML
+    text = html.escape(text, quote=False)
+
     # Replace delete tags
-    text = text.replace("<delete>", '<span class="deleted-text">')
-    text = text.replace("</delete>", '</span>')
+    text = text.replace("&lt;delete&gt;", '<span class="deleted-text">')
+    text = text.replace("&lt;/delete&gt;", '</span>')
     
     # Replace mark tags
-    text = text.replace("<mark>", '<span class="marked-text">')
-    text = text.replace("</mark>", '</span>')
+    text = text.replace("&lt;mark&gt;", '<span class="marked-text">')
+    text = text.replace("&lt;/mark&gt;", '</span>')
     
     # Replace numerical tags with bold styling
-    text = text.replace("<numerical>", '<span class="numerical-tag">&lt;numerical&gt;</span>')
-    text = text.replace("</numerical>", '<span class="numerical-tag">&lt;/numerical&gt;</span>')
+    text = text.replace("&lt;numerical&gt;", '<span class="numerical-tag">&lt;numerical&gt;</span>')
+    text = text.replace("&lt;/numerical&gt;", '<span class="numerical-tag">&lt;/numerical&gt;</span>')
     
     # Replace contradictory tags with bold styling
-    text = text.replace("<contradictory>", '<span class="contradictory-tag">&lt;contradictory&gt;</span>')
-    text = text.replace("</contradictory>", '<span class="contradictory-tag">&lt;/contradictory&gt;</span>')
+    text = text.replace("&lt;contradictory&gt;", '<span class="contradictory-tag">&lt;contradictory&gt;</span>')
+    text = text.replace("&lt;/contradictory&gt;", '<span class="contradictory-tag">&lt;/contradictory&gt;</span>')
     
     # Replace entity tags with bold styling
-    text = text.replace("<entity>", '<span class="entity-tag">&lt;entity&gt;</span>')
-    text = text.replace("</entity>", '<span class="entity-tag">&lt;/entity&gt;</span>')
+    text = text.replace("&lt;entity&gt;", '<span class="entity-tag">&lt;entity&gt;</span>')
+    text = text.replace("&lt;/entity&gt;", '<span class="entity-tag">&lt;/entity&gt;</span>')
     
     # Replace relation tags with bold styling
-    text = text.replace("<relation>", '<span class="relation-tag">&lt;relation&gt;</span>')
-    text = text.replace("</relation>", '<span class="relation-tag">&lt;/relation&gt;</span>')
+    text = text.replace("&lt;relation&gt;", '<span class="relation-tag">&lt;relation&gt;</span>')
+    text = text.replace("&lt;/relation&gt;", '<span class="relation-tag">&lt;/relation&gt;</span>')
     
     return text
 
+def render_edited(placeholder, text):
+    placeholder.markdown(f'<div class="edited-text">{process_edited_text(text)}</div>', unsafe_allow_html=True)
+
+class ResultCache:
+    """
+    LRU of detection results keyed by a hash of the backend and the input.
+
+    It is kept with `st.cache_resource`, so repeated queries and page reruns of every
+    session are answered without running the model.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(backend, references, passage):
+        payload = json.dumps([backend, references, passage], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._results:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._results.move_to_end(key)
+            return self._results[key]
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            if len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache()
+
+@st.cache_resource
+def load_detector(checkpoint_dir, device):
+    """Load the model once per checkpoint and device, shared by all sessions with a lock for generation."""
+    sys.path.append(os.path.join(parent_dir, "evaluation"))
+    from phi_4_inference import load_model
+    from serve import Detector
+
+    model, tokenizer = load_model(checkpoint_dir, device)
+    # Greedy decoding, so a cached result is the one the model would give again
+    return Detector(model, tokenizer, device, greedy=True), threading.Lock()
+
+def stream_detection(service_url, references, passage):
+    """Yield the lines of a /detect/stream response of the detection service (evaluation/serve.py)."""
+    request = urllib.request.Request(
+        service_url.rstrip("/") + "/detect/stream",
+        data=json.dumps({"references": references, "passage": passage}).encode("utf-8"),
+        headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            yield json.loads(line)
+
+def stream_local(detector, lock, references, passage):
+    """Yield the same lines as `stream_detection`, generating with the model loaded in the demo."""
+    pieces = queue.Queue()
+    result = {}
+
+    def work():
+        try:
+            with lock:
+                result.update(detector.stream({"references": references, "passage": passage}, pieces.put))
+        except Exception as error:
+            result["error"] = f"{type(error).__name__}: {error}"
+        finally:
+            pieces.put(None)
+
+    threading.Thread(target=work, daemon=True).start()
+    while True:
+        text = pieces.get()
+        if text is None:
+            break
+        yield {"text": text}
+    yield result
+
+def show_result(placeholder, result, cached=False):
+    render_edited(placeholder, result["postprocessed"])
+    st.caption(f"{'Cached result. ' if cached else ''}Model latency {result['latency_s']:.2f}s "
+               f"(first text after {result['first_text_s']:.2f}s), {result['generated_tokens']} tokens, "
+               f"{result['generated_tokens'] / max(result['latency_s'], 1e-9):.1f} tokens/s")
+
+# Live detection, with the model in a detection service or loaded in the demo
+st.header("Try It")
+backend = st.sidebar.radio("Backend", ["Detection service", "Local model"])
+if backend == "Detection service":
+    service_url = st.sidebar.text_input("Detection service", os.environ.get("HDE_SERVICE_URL", "http://localhost:8080"))
+    backend_id = service_url
+else:
+    checkpoint_dir = st.sidebar.text_input("Checkpoint", os.environ.get("HDE_CHECKPOINT_DIR", ""))
+    device = st.sidebar.selectbox("Device", ["cuda", "cpu"])
+    backend_id = f"{os.path.abspath(checkpoint_dir)}:{device}"
+result_cache = get_result_cache()
+
+col1, col2 = st.columns(2)
+
+with col1:
+    st.subheader("Reference Data")
+    live_reference = st.text_area("", "", height=240, key="live_reference")
+
+with col2:
+    st.subheader("LM Output")
+    live_output = st.text_area("", "", height=80, key="live_output")
+    has_input = bool(live_reference.strip() and live_output.strip())
+    run = st.button("Detect and Edit", disabled=not has_input)
+
+    st.subheader("Edited Version")
+    placeholder = st.empty()
+    key = ResultCache.make_key(backend_id, live_reference, live_output)
+    cached = result_cache.get(key) if has_input else None
+    if cached is not None:
+        show_result(placeholder, cached, cached=True)
+    elif run:
+        start = time.perf_counter()
+        first_text = None
+        text = ""
+        try:
+            if backend == "Detection service":
+                lines = stream_detection(service_url, live_reference, live_output)
+            else:
+                with st.spinner("Loading the model..."):
+                    detector, lock = load_detector(checkpoint_dir, device)
+                start = time.perf_counter()
+                lines = stream_local(detector, lock, live_reference, live_output)
+            for item in lines:
+                if "text" in item:
+                    first_text = first_text or time.perf_counter() - start
+                    text += item["text"]
+                    # Tags still being generated are closed so the partial output renders
+                    render_edited(placeholder, close_open_tags(text))
+                elif "error" in item:
+                    st.error(item["error"])
+                else:
+                    latency = time.perf_counter() - start
+                    result = {
+                        "postprocessed": item["postprocessed"],
+                        "generated_tokens": item["generated_tokens"],
+                        "latency_s": latency,
+                        "first_text_s": first_text or latency,
+                    }
+                    result_cache.put(key, result)
+                    show_result(placeholder, result)
+        except OSError as error:
+            if backend == "Detection service":
+                st.error(f"Could not reach the detection service at {service_url}: {error}")
+            else:
+                st.error(f"Could not load the model from {checkpoint_dir!r}: {error}")
+        except Exception as error:
+            # Generation errors of the local model are reported by stream_local, so anything else
+            # comes from load_detector, e.g. a ValueError for a checkpoint without weights
+            if backend == "Detection service":
+                raise
+            st.error(f"Could not load the model from {checkpoint_dir!r}: {type(error).__name__}: {error}")
+
     # Third Example
 st.header("Example 1")
 
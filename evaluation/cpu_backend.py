@@ -0,0 +1,60 @@
+"""
+CPU inference backend for the fine-tuned detector.
+
+unsloth only runs on CUDA GPUs, so on CPU-only nodes the LoRA checkpoint is loaded with
+peft on a float32 copy of its base model, the adapter is merged into the base weights,
+and the result is optionally converted with PyTorch dynamic int8 quantization, which
+replaces every nn.Linear with an int8 kernel and typically gives a 2-3x speedup over
+float32 on x86 CPUs.
+"""
+import re
+
+import torch
+from peft import PeftConfig, PeftModel
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+# unsloth publishes every base model both pre-quantized ("unsloth/phi-4-bnb-4bit") and in
+# full precision ("unsloth/phi-4"); 4-bit weights cannot be loaded on CPU
+BNB_4BIT_SUFFIX = re.compile(r"(-unsloth)?-bnb-4bit$")
+
+
+def full_precision_base(base_model_name_or_path):
+    """Name of the full precision variant of an unsloth base model."""
+    return BNB_4BIT_SUFFIX.sub("", base_model_name_or_path)
+
+
+def load_cpu_model(checkpoint_dir, quantize="int8", num_threads=None):
+    """
+    Load a checkpoint for CPU inference.
+
+    Args:
+        checkpoint_dir (str): Same LoRA checkpoint directory as used with unsloth on GPU.
+        quantize (str): "int8" for dynamic int8 quantization of the linear layers, "none" for float32.
+        num_threads (int, optional): Intra-op threads used by PyTorch; all cores if None.
+
+    Returns:
+        tuple: (model, tokenizer)
+
+    Example:
+        >>> model, tokenizer = load_cpu_model("checkpoints/phi-4-detector", quantize="int8", num_threads=16)
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    tokenizer = AutoTokenizer.from_pretrained(checkpoint_dir)
+
+    # The base model is loaded without the bitsandbytes quantization config of training
+    base_model = full_precision_base(PeftConfig.from_pretrained(checkpoint_dir).base_model_name_or_path)
+    config = AutoConfig.from_pretrained(base_model)
+    if hasattr(config, "quantization_config"):
+        del config.quantization_config
+    model = AutoModelForCausalLM.from_pretrained(
+        base_model, config=config, torch_dtype=torch.float32, device_map="cpu", low_cpu_mem_usage=True)
+
+    # LoRA weights are folded into the base model so quantization covers them too
+    model = PeftModel.from_pretrained(model, checkpoint_dir).merge_and_unload()
+    model.eval()
+
+    if quantize == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, tokenizer
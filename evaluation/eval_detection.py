@@ -1,9 +1,14 @@
 import pandas as pd
-import spacy
+import argparse
+import sys
+import os
 from collections import Counter
 import textwrap
 
-nlp = spacy.load("en_core_web_sm")
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import read_table, write_table, get_nlp
 
 error_types = [
         "<numerical>",
@@ -17,7 +22,7 @@ error_types = [
 # splits passage into sentences
 def split_sentences(text):
     sentences = []
-    doc = nlp(text)
+    doc = get_nlp()(text)
     for sent in doc.sents:
         sentences.append(sent.text)
   #  sentences = text.split(".")
@@ -88,7 +93,7 @@ def parse_args():
         "--input_file",
         type=str,
         default=None,
-        help="Input .csv file for evaluation")
+        help="Input .csv/.parquet/.arrow file for evaluation")
     parser.add_argument(
         "--output_file",
         type=str,
@@ -102,8 +107,8 @@ def parse_args():
 if __name__ == "__main__":
     args = parse_args()
     
-    df = pd.read_csv(args.input_file)
+    df = read_table(args.input_file, columns=['response_postprocessed', 'completion'])
     df_result, TP, FP, FN = run_eval(df)
-    df_result.to+_csv(args.output_file)
+    write_table(df_result, args.output_file)
 
 
@@ -1,6 +1,6 @@
 import os
+import argparse
 import pandas as pd
-import spacy
 import numpy as np
 import sys
 
@@ -8,9 +8,6 @@ import sys
 parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
 sys.path.append(parent_dir)
 from utils import *
-from FactScoreLite.FactScoreLite.fact_scorer import FactScorer
-
-nlp = spacy.load("en_core_web_sm")
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -18,7 +15,7 @@ def parse_args():
         "--input_file",
         type=str,
         default=None,
-        help="Input .csv file for evalution")
+        help="Input .csv/.parquet/.arrow file for evalution")
 
     args = parser.parse_args()
     return args
@@ -44,9 +41,10 @@ if __name__ == "__main__":
     args = parse_args()
 
     ### Load data
-    df = pd.read_csv(args.input_file)
+    df = read_table(args.input_file, columns=['prompt', 'response_postprocessed'])
 
     ### Load model
+    from FactScoreLite.FactScoreLite.fact_scorer import FactScorer
     fs = FactScorer()
 
     score_edits = run_eval(fs, df)
@@ -0,0 +1,88 @@
+"""
+Passage-aware generation length and early stopping for the detector.
+
+A completion is the input passage (the text after `Text:` in the prompt) with error tags
+inserted, so it ends where the passage ends. Removing the <mark> replacements and
+unwrapping all other tags of a completion gives back the passage, which is used to
+bound the number of new tokens per request and to stop generating once the end of the
+passage has been reproduced and every tag is closed.
+"""
+import re
+
+from transformers import StoppingCriteria
+
+from tag_parser import parse_tags, render, iter_nodes, CLOSING_TAGS
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def extract_passage(prompt):
+    """Return the passage to annotate, i.e. the text after `Text:` of a detection prompt."""
+    if "Text:" not in prompt:
+        return ""
+    return prompt.split("Text:", 1)[1].strip()
+
+
+def normalize(text):
+    return WHITESPACE.sub(" ", text).strip()
+
+
+def reproduced_passage(completion):
+    """Return the part of the input passage a (partial) completion has reproduced."""
+    # <mark> holds the suggested replacement, which is not part of the input passage
+    return render(parse_tags(completion), lambda node: [] if node.tag == "mark" and node.closed else node.children)
+
+
+def all_tags_closed(completion):
+    return all(node.closed for node, _ in iter_nodes(parse_tags(completion, CLOSING_TAGS)))
+
+
+class PassageEndCriteria(StoppingCriteria):
+    """
+    Stop generation once every row of a batch has reproduced the end of its passage.
+
+    Only the last `window_tokens` generated tokens are decoded at each step; the whole
+    completion of a row is decoded only when that tail already ends with the passage.
+    Rows finishing early keep generating until the whole batch stops, so `stop_lengths`
+    records where each row finished and the caller truncates its tokens there.
+
+    Args:
+        tokenizer: Tokenizer of the model.
+        passages (list of str): Input passage of every row of the batch.
+        prompt_length (int): Length of the (padded) prompt part of `input_ids`.
+        tail_chars (int): Number of trailing passage characters that must be reproduced.
+        window_tokens (int): Number of trailing tokens decoded for the cheap check.
+
+    Example:
+        >>> criteria = PassageEndCriteria(tokenizer, passages, inputs["input_ids"].shape[1])
+        >>> outputs = model.generate(**inputs, stopping_criteria=StoppingCriteriaList([criteria]))
+        >>> lengths = [criteria.stop_lengths.get(i, outputs.shape[1] - prompt_length) for i in range(len(passages))]
+    """
+
+    def __init__(self, tokenizer, passages, prompt_length, tail_chars=32, window_tokens=64):
+        self.tokenizer = tokenizer
+        self.tails = [normalize(passage)[-tail_chars:] for passage in passages]
+        self.prompt_length = prompt_length
+        self.window_tokens = window_tokens
+        self.stop_lengths = {}
+
+    def is_finished(self, row, generated):
+        if not self.tails[row]:
+            return False
+        tail = self.tokenizer.decode(generated[-self.window_tokens:], skip_special_tokens=True)
+        if not normalize(reproduced_passage(tail)).endswith(self.tails[row]):
+            return False
+        completion = self.tokenizer.decode(generated, skip_special_tokens=True)
+        return all_tags_closed(completion) and normalize(reproduced_passage(completion)).endswith(self.tails[row])
+
+    def __call__(self, input_ids, scores, **kwargs):
+        eos_token_id = self.tokenizer.eos_token_id
+        for row in range(input_ids.shape[0]):
+            if row in self.stop_lengths:
+                continue
+            generated = input_ids[row, self.prompt_length:]
+            if eos_token_id is not None and len(generated) and generated[-1] == eos_token_id:
+                self.stop_lengths[row] = len(generated)
+            elif self.is_finished(row, generated):
+                self.stop_lengths[row] = len(generated)
+        return len(self.stop_lengths) == input_ids.shape[0]
@@ -1,6 +1,15 @@
-from datasets import load_dataset
-from unsloth import FastLanguageModel
 import pandas as pd
+import argparse
+import hashlib
+import sys
+import os
+import time
+from collections import Counter
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import read_table, write_table, append_jsonl, read_jsonl, rewrite_jsonl
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -19,24 +28,248 @@ def parse_args():
         type=str,
         default=None,
         help="Output file from inference")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="maximum number of prompts generated together")
+    parser.add_argument(
+        "--max_batch_tokens",
+        type=int,
+        default=None,
+        help="token budget of a batch, counted as batch size x (longest prompt + generation length)")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda",
+        choices=["cuda", "cpu"],
+        help="cuda: unsloth 4-bit model on GPU, cpu: transformers model on CPU")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default="int8",
+        choices=["int8", "none"],
+        help="quantization of the CPU model: dynamic int8 or float32")
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        default=None,
+        help="number of threads for CPU inference (default: all cores)")
+    parser.add_argument(
+        "--max_seq_length",
+        type=int,
+        default=8192,
+        help="context length of the model; longer prompts are flagged or truncated")
+    parser.add_argument(
+        "--truncation",
+        type=str,
+        default="none",
+        choices=["none", "references"],
+        help="for prompts over max_seq_length, none: only report them, references: shorten their references")
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=4,
+        help="number of processes tokenizing the input file")
+    parser.add_argument(
+        "--tokenized_cache_dir",
+        type=str,
+        default=None,
+        help="cache of tokenized prompts (default: input_file + .tokenized)")
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=2048,
+        help="upper bound on the generation length of any prompt")
+    parser.add_argument(
+        "--tag_allowance",
+        type=int,
+        default=256,
+        help="tokens allowed for tag markup on top of the passage length")
+    parser.add_argument(
+        "--no_passage_stop",
+        action="store_true",
+        help="do not stop generation once the end of the passage is reproduced")
+    parser.add_argument(
+        "--prompt_lookup",
+        action="store_true",
+        help="greedy decoding with drafts copied from the passage (prompt-lookup speculative decoding), one prompt at a time")
+    parser.add_argument(
+        "--journal_file",
+        type=str,
+        default=None,
+        help="JSONL file recording finished prompts (default: output_file + .journal.jsonl)")
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip prompts already recorded in the journal file")
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="number of workers the input file is split across")
+    parser.add_argument(
+        "--shard_id",
+        type=int,
+        default=0,
+        help="shard handled by this worker, from 0 to num_shards - 1")
     args = parser.parse_args()
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error("--shard_id must be between 0 and num_shards - 1")
     return args
 
+def make_batches(lengths, batch_size, max_batch_tokens=None, max_new_tokens=0):
+    """
+    Group prompts into batches of similar length.
+
+    Prompts are sorted by token length, so each batch is padded to little more than its
+    own prompts. A batch is closed once it holds `batch_size` prompts or once the next
+    prompt would push the padded batch, including the tokens to generate, over
+    `max_batch_tokens`.
+
+    Args:
+        lengths (list of int): Token length of every prompt.
+        batch_size (int): Maximum number of prompts per batch.
+        max_batch_tokens (int, optional): Token budget per batch; no budget if None.
+        max_new_tokens (int): Tokens generated per prompt.
+
+    Returns:
+        list of list of int: Prompt indices of every batch.
+
+    Example:
+        >>> make_batches([30, 5, 12, 7], batch_size=2)
+        [[1, 3], [2, 0]]
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches, batch = [], []
+    for i in order:
+        padded_tokens = (len(batch) + 1) * (lengths[i] + max_new_tokens)
+        over_budget = max_batch_tokens is not None and padded_tokens > max_batch_tokens
+        if batch and (len(batch) >= batch_size or over_budget):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def prompt_hash(prompt):
+    """Key of a prompt in the inference journal."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def shard_of(prompt, num_shards):
+    """
+    Shard a prompt is assigned to.
+
+    The assignment depends only on the prompt, so it is the same on every host and
+    across reruns, and repeated prompts are generated once, by the same worker.
+    """
+    return int(prompt_hash(prompt), 16) % num_shards
+
+def load_model(checkpoint_dir, device="cuda", quantize="int8", cpu_threads=None, max_seq_length=8192):
+    """Load the fine-tuned model with unsloth on GPU or with transformers on CPU, ready for batched generation."""
+    if device == "cpu":
+        from cpu_backend import load_cpu_model
+        model, tokenizer = load_cpu_model(checkpoint_dir, quantize, cpu_threads)
+    else:
+        from unsloth import FastLanguageModel
+        load_in_4bit = True
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name = checkpoint_dir, # YOUR MODEL YOU USED FOR TRAINING
+            max_seq_length = max_seq_length,
+            load_in_4bit = load_in_4bit,
+        )
+        FastLanguageModel.for_inference(model) # Enable native 2x faster inference
+
+    # Batched generation appends to the right, so prompts are padded on the left
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return model, tokenizer
+
+def generate_batch(model, tokenizer, prompt_ids, passages, max_new_tokens, device="cuda", passage_stop=True, greedy=False, streamer=None):
+    """
+    Generate completions for a batch of tokenized chat-formatted prompts.
+
+    Args:
+        prompt_ids (list of list of int): Token ids of the prompts with the chat template applied.
+        passages (list of str): Input passage of every prompt.
+        max_new_tokens (list of int): Generation length limit of every prompt.
+        passage_stop (bool): Stop once every row has reproduced the end of its passage.
+        greedy (bool): Force greedy decoding instead of the model's generation config with the sampling settings below.
+        streamer (optional): transformers streamer receiving the tokens as they are generated, for a single prompt
+            (see streaming.CallbackStreamer).
+
+    Returns:
+        list of list of int: Generated token ids of every prompt, cut at its own limit and at EOS.
+    """
+    from transformers import StoppingCriteriaList
+    from passage_stopping import PassageEndCriteria
+
+    inputs = tokenizer.pad(
+        {"input_ids": prompt_ids},
+        padding = True,
+        return_tensors = "pt",
+    ).to(device)
+
+    prompt_length = inputs["input_ids"].shape[1]
+    criteria = PassageEndCriteria(tokenizer, passages, prompt_length)
+    sampling = {"do_sample": False} if greedy else {"temperature": 1.5, "min_p": 0.1}
+    outputs = model.generate(
+        **inputs, max_new_tokens = max(max_new_tokens), use_cache = True, **sampling,
+        stopping_criteria = StoppingCriteriaList([criteria]) if passage_stop else None,
+        streamer = streamer,
+    )
+    # Batch input case; rows are cut at their own length limit or where they reproduced the passage end
+    generated = []
+    for k, row in enumerate(outputs[:, prompt_length:].tolist()):
+        row = row[:min(max_new_tokens[k], criteria.stop_lengths.get(k, max_new_tokens[k]))]
+        if tokenizer.eos_token_id in row:
+            row = row[:row.index(tokenizer.eos_token_id) + 1]
+        generated.append(row)
+    return generated
+
+def generate_prompt_lookup(model, tokenizer, prompt_ids, passage, passage_ids, max_new_tokens, device="cuda", passage_stop=True):
+    """
+    Generate one completion greedily with prompt-lookup speculative decoding.
+
+    Drafts are copied from `passage_ids`, the token ids of the passage.
+
+    Returns:
+        tuple: (generated token ids, stats dict of `prompt_lookup_generate`)
+    """
+    import torch
+    from passage_stopping import PassageEndCriteria
+    from prompt_lookup import prompt_lookup_generate
+
+    input_ids = torch.tensor([prompt_ids], device = device)
+    criteria = PassageEndCriteria(tokenizer, [passage], input_ids.shape[1])
+    generated, stats = prompt_lookup_generate(
+        model, input_ids, passage_ids, max_new_tokens,
+        eos_token_id = tokenizer.eos_token_id,
+        stopping_criteria = criteria if passage_stop else None,
+    )
+    return generated[:criteria.stop_lengths.get(0, len(generated))], stats
+
 if __name__ == "__main__":
     args = parse_args()
 
-    max_seq_length = 8192
-    load_in_4bit = True
-    model, tokenizer = FastLanguageModel.from_pretrained(
-        model_name = args.checkpoint_dir, # YOUR MODEL YOU USED FOR TRAINING
-        max_seq_length = max_seq_length,
-        load_in_4bit = load_in_4bit,
-    )
-    FastLanguageModel.for_inference(model) # Enable native 2x faster inference
+    # Imported only once the arguments are parsed, so e.g. --help returns immediately
+    from datasets import Dataset
+    from passage_stopping import extract_passage
+    from pretokenize import pretokenize, length_histogram, render_prompt, truncate_references
 
     """## Load data"""
-    ds = load_dataset("csv", data_files=args.input_file)
-    ds = ds['train']
+    df = read_table(args.input_file)
+    # Dictionary-encoded columns are not supported by datasets features
+    df = df.astype({column: str for column in df.select_dtypes("category").columns})
+    if args.num_shards > 1:
+        # Shard outputs keep the input row position so merge_shards can restore the order;
+        # positions, not index labels, since filtered input tables have gaps in their index
+        df.insert(0, 'row_index', range(len(df)))
+        df = df[[shard_of(prompt, args.num_shards) == args.shard_id for prompt in df['prompt']]]
+        print(f"Shard {args.shard_id} of {args.num_shards}: {len(df)} rows")
+    ds = Dataset.from_pandas(df, preserve_index=False)
 
     def add_conversations_feature_for_inference(dataset):
         def create_conversation(example):
@@ -50,26 +283,91 @@ if __name__ == "__main__":
 
     ds = add_conversations_feature_for_inference(ds)
 
-    responses = []
-    for i, messages in enumerate(ds['conversations']):
-    
-        inputs = tokenizer.apply_chat_template(
-                messages,
-                tokenize = True,
-                add_generation_prompt = True, # Must add for generation
-                return_tensors = "pt",
-            ).to("cuda")
-
-        outputs = model.generate(
-            input_ids = inputs, max_new_tokens = 2048, use_cache = True, temperature = 1.5, min_p = 0.1
-        )
-        # Batch input case
-        generated_tokens = outputs[:, inputs.shape[1]:]
-        response = tokenizer.batch_decode(generated_tokens, skip_special_tokens=True)
-        responses.append(response[0])
+    ### Resume from the journal of a previous run
+    hashes = [prompt_hash(prompt) for prompt in ds['prompt']]
+    journal_file = args.journal_file or args.output_file + ".journal.jsonl"
+    completed = {}
+    if args.resume:
+        for record in read_jsonl(journal_file):
+            completed[record['prompt_hash']] = record['response_inference']
+    # Rewrite the journal so a truncated last line from a crash cannot corrupt new appends
+    rewrite_jsonl(journal_file, [{'prompt_hash': h, 'response_inference': r} for h, r in completed.items()])
+
+    # Rows still to generate, with repeated prompts generated once
+    pending = {}
+    for i, h in enumerate(hashes):
+        if h not in completed:
+            pending.setdefault(h, i)
+    pending = list(pending.values())
+    print(f"{len(pending)} prompts to generate, {len(completed)} already in {journal_file}")
+
+    ### Load model
+    model, tokenizer = load_model(args.checkpoint_dir, args.device, args.quantize, args.cpu_threads, args.max_seq_length)
+
+    ### Tokenize the whole file once, reusing the cache of earlier runs
+    tokenized = pretokenize(ds, tokenizer, args.tokenized_cache_dir or args.input_file + ".tokenized", args.num_proc)
+    print(length_histogram(tokenized["prompt_length"], args.max_seq_length))
+    tokenized = tokenized.select(pending)
+    prompt_ids = tokenized["input_ids"]
+    passage_ids = tokenized["passage_ids"]
+
+    # A completion repeats the passage with tags inserted, so its length is bounded by the passage
+    prompts = ds['prompt']
+    passages = [extract_passage(prompts[i]) for i in pending]
+    max_new_tokens = [min(n + args.tag_allowance, args.max_new_tokens) for n in tokenized["passage_length"]]
+
+    # Prompts that do not fit the context together with their generation budget
+    over_budget = [j for j in range(len(pending)) if len(prompt_ids[j]) + max_new_tokens[j] > args.max_seq_length]
+    if over_budget:
+        print(f"{len(over_budget)} prompts exceed max_seq_length={args.max_seq_length}, "
+              f"e.g. rows {[pending[j] for j in over_budget[:10]]}")
+    if args.truncation == "references":
+        for j in over_budget:
+            excess = len(prompt_ids[j]) + max_new_tokens[j] - args.max_seq_length
+            prompt = truncate_references(prompts[pending[j]], tokenizer, excess)
+            prompt_ids[j] = tokenizer(render_prompt(tokenizer, prompt), add_special_tokens = False)["input_ids"]
+    total_lengths = [len(ids) + m for ids, m in zip(prompt_ids, max_new_tokens)]
+
+    # Batches are formed over length-sorted prompts; each finished batch is journaled right away
+    batch_size = 1 if args.prompt_lookup else args.batch_size
+    start = time.perf_counter()
+    num_tokens = 0
+    lookup_stats = Counter()
+    for batch in make_batches(total_lengths, batch_size, args.max_batch_tokens):
+        if args.prompt_lookup:
+            j = batch[0]
+            generated, stats = generate_prompt_lookup(
+                model, tokenizer, prompt_ids[j], passages[j], passage_ids[j], max_new_tokens[j], args.device, not args.no_passage_stop)
+            generated = [generated]
+            lookup_stats.update(stats)
+        else:
+            generated = generate_batch(
+                model, tokenizer, [prompt_ids[j] for j in batch], [passages[j] for j in batch],
+                [max_new_tokens[j] for j in batch], args.device, not args.no_passage_stop)
+        num_tokens += sum(len(ids) for ids in generated)
+
+        responses = tokenizer.batch_decode(generated, skip_special_tokens=True)
+        append_jsonl(journal_file, [
+            {'prompt_hash': hashes[pending[j]], 'response_inference': response}
+            for j, response in zip(batch, responses)
+        ])
+
+    seconds = time.perf_counter() - start
+    if pending:
+        print(f"Generated {num_tokens} tokens in {seconds:.1f}s ({num_tokens / seconds:.1f} tokens/s)")
+    if lookup_stats["drafted"]:
+        print(f"Prompt lookup: {lookup_stats['accepted']} of {lookup_stats['drafted']} draft tokens accepted "
+              f"({lookup_stats['accepted'] / lookup_stats['drafted']:.1%}), {lookup_stats['forward_passes']} forward passes")
+
+    ### Build the output from the journal, in input row order
+    completed = {record['prompt_hash']: record['response_inference'] for record in read_jsonl(journal_file)}
+    missing = [i for i, h in enumerate(hashes) if h not in completed]
+    if missing:
+        sys.exit(f"{len(missing)} rows have no response; rerun with --resume to generate them")
+    responses = [completed[h] for h in hashes]
 
     df = ds.to_pandas()
     df['response_inference'] = responses
 
-    df.to_csv(args.output_file, index=False)
+    write_table(df, args.output_file, index=False)
 
@@ -1,4 +1,5 @@
 import pandas as pd
+import argparse
 import sys
 import os
 
@@ -6,6 +7,7 @@ import os
 parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
 sys.path.append(parent_dir)
 from utils import *
+from span_classifier import SpanClassifier, correct_tags
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -13,80 +15,61 @@ def parse_args():
         "--input_file",
         type=str,
         default=None,
-        help="Input .csv file from inference")
+        help="Input .csv/.parquet/.arrow file from inference")
     parser.add_argument(
         "--output_file",
         type=str,
         default=None,
-        help="Output .csv file from postprocessing")
+        help="Output .csv/.parquet/.arrow file from postprocessing")
+    parser.add_argument(
+        "--span_cache_file",
+        type=str,
+        default=None,
+        help="Optional JSON file persisting span classifications across runs and stages")
     args = parser.parse_args()
     return args
 
-def correct_tags(text):
-        """
-        Corrects tag types in a given annotated text based on whether content is numerical, temporal, or relation.
-        """
+def correct_numerical(text):
+    """Undo a <numerical> edit whose <mark> and <delete> values are identical or equal up to rounding."""
+    pattern = r"<numerical><mark>(.*?)</mark><delete>(.*?)</delete></numerical>"
+    match = re.search(pattern, text, re.DOTALL)
 
-        def correct_tag_type(old_tag, delete_val, mark_val):
-            """Determine the appropriate tag based on delete/mark values."""
-            if is_temporal(delete_val) and is_temporal(mark_val):
-                return "temporal"
-            elif is_numerical(delete_val) and is_numerical(mark_val):
-                return "numerical"
-            elif contains_only_nouns_or_phrases(delete_val) and contains_only_nouns_or_phrases(mark_val):
-                return "entity"  
-            elif contains_only_verbs_adj_adv(delete_val) and contains_only_verbs_adj_adv(mark_val):
-                return "relation" 
-            else:
-                return old_tag 
-        pattern = re.compile(r"<(entity|temporal|numerical|relation)><delete>(.*?)</delete><mark>(.*?)</mark></\1>", re.DOTALL)
+    if match:
+        mark_text, delete_text = match.groups()
+        if mark_text == delete_text:
+            text =  replace_tagged_with_mark(text)
 
-        def replacer(match):
-            old_tag = match.group(1)
-            delete_val = match.group(2).strip()
-            mark_val = match.group(3).strip()
-
-            new_tag = correct_tag_type(old_tag, delete_val, mark_val)
-            return f"<{new_tag}><delete>{delete_val}</delete><mark>{mark_val}</mark></{new_tag}>"
+        if is_numerical(mark_text) and is_numerical(delete_text):
+            a, b = match_lower_precision(extract_numerical_value(mark_text), extract_numerical_value(delete_text))
+            if a == b:
+                text =  replace_tagged_with_mark(text)
 
-        return pattern.sub(replacer, text)
+    return text
 
+def postprocess_response(text, classifier=None):
+    """Apply both postprocessing steps of this script to a single model completion."""
+    return correct_tags(correct_numerical(text), classifier)
 
 if __name__ == "__main__":
     args = parse_args()
 
     ### Load Data
-    df = pd.read_csv(args.input_file)
+    df = read_table(args.input_file)
 
     ### I. check for identical numerical values or rounding errors
-    results = []
-    for _, row in df.iterrows():
-        text = row['response_inference']
-
-        pattern = r"<numerical><mark>(.*?)</mark><delete>(.*?)</delete></numerical>"
-        match = re.search(pattern, text, re.DOTALL)
-
-        if match:
-            mark_text, delete_text = match.groups()
-            if mark_text == delete_text:
-                text =  replace_tagged_with_mark(text)
-
-            if is_numerical(mark_text) and is_numerical(delete_text):
-                a, b = match_lower_precision(extract_numerical_value(mark_text), extract_numerical_value(delete_text))
-                if a == b:
-                    text =  replace_tagged_with_mark(text)
-
-        results.append(text)
-
-    df['response_numerical_correction'] = results
+    df['response_numerical_correction'] = [correct_numerical(text) for text in df['response_inference']]
 
 
-    ### II. Correcting tags
+    ### II. Correcting tags, with the POS analysis of all spans batched into one spaCy run
+    classifier = SpanClassifier(cache_file=args.span_cache_file)
+    classifier.prime(collect_tag_spans(df['response_numerical_correction']))
     results = []
-    for i, row in df.iterrows():
-        s = correct_tags(row['response_numerical_correction'])
+    for text in df['response_numerical_correction']:
+        s = correct_tags(text, classifier)
         results.append(s)
 
     df['response_postprocessed'] = results
 
-    df.to_csv(args.output_file)
+    write_table(df, args.output_file)
+    print(f"Span classifier: {classifier.stats()}")
+    classifier.save()
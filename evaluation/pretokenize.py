@@ -0,0 +1,175 @@
+"""
+Tokenize an inference input file once and cache the token ids on disk.
+
+Prompts are rendered with the chat template and tokenized in batches with
+`datasets.map(batched=True, num_proc=...)`, together with the passage after `Text:`,
+which bounds the generation length and serves as the draft source of prompt lookup.
+The result is saved with `save_to_disk` under a key built from the tokenizer, its chat
+template and the prompts, so later runs on the same file load it instead of
+tokenizing again, and any change to the tokenizer or the data produces a new cache.
+
+Usage:
+    python pretokenize.py --checkpoint_dir {checkpoint_dir} --input_file {input_file_path} --num_proc 8
+"""
+import argparse
+import hashlib
+import json
+import sys
+import os
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import read_table, extract_references_and_passage, build_prompt
+from passage_stopping import extract_passage
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="checkpoint whose tokenizer is used")
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        default=None,
+        help="Input file for inference")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="directory of tokenized datasets (default: input_file + .tokenized)")
+    parser.add_argument(
+        "--num_proc",
+        type=int,
+        default=4,
+        help="number of tokenization processes")
+    parser.add_argument(
+        "--max_seq_length",
+        type=int,
+        default=8192,
+        help="context length prompts plus generation must fit in")
+    parser.add_argument(
+        "--generation_allowance",
+        type=int,
+        default=256,
+        help="tokens reserved for tag markup on top of the passage when checking the budget")
+    args = parser.parse_args()
+    return args
+
+
+def render_prompt(tokenizer, prompt):
+    """Apply the chat template to a detection prompt, ready for generation."""
+    return tokenizer.apply_chat_template(
+        [{"role": "user", "content": prompt}],
+        tokenize = False,
+        add_generation_prompt = True, # Must add for generation
+    )
+
+
+def cache_key(tokenizer, prompts):
+    """Key of a tokenized dataset: the tokenizer, its chat template and the prompts."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([tokenizer.name_or_path, len(tokenizer), tokenizer.chat_template]).encode("utf-8"))
+    for prompt in prompts:
+        digest.update(hashlib.sha256(prompt.encode("utf-8")).digest())
+    return digest.hexdigest()[:16]
+
+
+def pretokenize(ds, tokenizer, cache_dir, num_proc=4, batch_size=256):
+    """
+    Return the token ids of every prompt of `ds`, loading them from `cache_dir` when possible.
+
+    Args:
+        ds (datasets.Dataset): Dataset with a `prompt` column.
+        tokenizer: Tokenizer of the model.
+        cache_dir (str): Directory holding one saved dataset per cache key.
+        num_proc (int): Number of tokenization processes.
+        batch_size (int): Rows per `map` batch.
+
+    Returns:
+        datasets.Dataset: Rows aligned with `ds`, with columns `input_ids` (chat-formatted
+        prompt), `prompt_length`, `passage_ids` and `passage_length`.
+    """
+    from datasets import load_from_disk
+
+    path = os.path.join(cache_dir, cache_key(tokenizer, ds["prompt"]))
+    if os.path.exists(path):
+        print(f"Loading tokenized prompts from {path}")
+        return load_from_disk(path)
+
+    def tokenize_batch(batch):
+        texts = [render_prompt(tokenizer, prompt) for prompt in batch["prompt"]]
+        input_ids = tokenizer(texts, add_special_tokens = False)["input_ids"]
+        passage_ids = tokenizer([extract_passage(prompt) for prompt in batch["prompt"]], add_special_tokens = False)["input_ids"]
+        return {
+            "input_ids": input_ids,
+            "prompt_length": [len(ids) for ids in input_ids],
+            "passage_ids": passage_ids,
+            "passage_length": [len(ids) for ids in passage_ids],
+        }
+
+    tokenized = ds.map(
+        tokenize_batch,
+        batched = True,
+        batch_size = batch_size,
+        num_proc = num_proc if len(ds) > batch_size else None,
+        remove_columns = ds.column_names,
+        desc = "Tokenizing prompts",
+    )
+    tokenized.save_to_disk(path)
+    return tokenized
+
+
+def truncate_references(prompt, tokenizer, excess_tokens):
+    """
+    Shorten the references of a prompt by about `excess_tokens` tokens, keeping the passage intact.
+
+    Returns:
+        str: The prompt with truncated references.
+    """
+    reference, passage = extract_references_and_passage(prompt)
+    reference_ids = tokenizer(reference, add_special_tokens = False)["input_ids"]
+    keep = max(len(reference_ids) - excess_tokens, 0)
+    return build_prompt(tokenizer.decode(reference_ids[:keep]), passage)
+
+
+def length_histogram(lengths, max_seq_length, bin_size=512):
+    """Render a text histogram of prompt token lengths, marking bins beyond `max_seq_length`."""
+    lengths = sorted(lengths)
+    if not lengths:
+        return "no prompts"
+    counts = {}
+    for length in lengths:
+        counts[length // bin_size] = counts.get(length // bin_size, 0) + 1
+
+    lines = []
+    scale = 50 / max(counts.values())
+    for b in range(max(counts) + 1):
+        count = counts.get(b, 0)
+        marker = " over budget" if (b + 1) * bin_size > max_seq_length else ""
+        lines.append(f"{b * bin_size:>6}-{(b + 1) * bin_size - 1:<6} {count:>7} {'#' * round(count * scale)}{marker}")
+    percentile = lambda q: lengths[min(int(q * len(lengths)), len(lengths) - 1)]
+    lines.append(f"p50 {percentile(0.5)}  p90 {percentile(0.9)}  p99 {percentile(0.99)}  max {lengths[-1]}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    from datasets import Dataset
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.checkpoint_dir)
+    df = read_table(args.input_file, columns=["prompt"])
+    ds = Dataset.from_pandas(df.astype({"prompt": str}), preserve_index=False)
+
+    tokenized = pretokenize(ds, tokenizer, args.cache_dir or args.input_file + ".tokenized", args.num_proc)
+    print(length_histogram(tokenized["prompt_length"], args.max_seq_length))
+    over_budget = [
+        i for i, (prompt_length, passage_length) in enumerate(zip(tokenized["prompt_length"], tokenized["passage_length"]))
+        if prompt_length + passage_length + args.generation_allowance > args.max_seq_length
+    ]
+    print(f"{len(over_budget)} of {len(tokenized)} prompts exceed max_seq_length={args.max_seq_length} with their generation budget")
@@ -0,0 +1,113 @@
+"""
+Prompt-lookup speculative decoding for the detector.
+
+A completion is the input passage with error tags inserted, so most of its tokens can be
+copied from the passage. At every step the last n-gram of the sequence is looked up in
+the passage tokens, and the tokens that followed it there are proposed as a draft. The
+model scores the current token and the whole draft in one forward pass; draft tokens
+are accepted for as long as they equal the model's own greedy choice, and the first
+disagreement is replaced by the model's token. The output is therefore the same as
+plain greedy decoding, while a well-copied passage needs only a fraction of the
+forward passes.
+"""
+import torch
+
+
+def find_draft(sequence, source, max_ngram=3, num_draft=10):
+    """
+    Propose the tokens that followed the latest match of the sequence's last n-gram in `source`.
+
+    Longer n-grams are tried first; the last occurrence in `source` is used, since the
+    passage is reproduced front to back.
+
+    Args:
+        sequence (list of int): Tokens generated so far, including the prompt.
+        source (list of int): Tokens to copy from, i.e. the passage.
+        max_ngram (int): Longest n-gram to match.
+        num_draft (int): Maximum number of draft tokens.
+
+    Returns:
+        list of int: Draft tokens, empty if no n-gram matches.
+
+    Example:
+        >>> find_draft([5, 1, 2], source=[1, 2, 3, 4, 1, 9], max_ngram=2, num_draft=2)
+        [3, 4]
+    """
+    for n in range(min(max_ngram, len(sequence)), 0, -1):
+        ngram = sequence[-n:]
+        for start in range(len(source) - n, -1, -1):
+            if source[start:start + n] == ngram and start + n < len(source):
+                return source[start + n:start + n + num_draft]
+    return []
+
+
+def crop_cache(past_key_values, length):
+    """Keep the first `length` positions of a KV cache, either a Cache object or legacy tuples."""
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    return tuple((key[:, :, :length, :], value[:, :, :length, :]) for key, value in past_key_values)
+
+
+@torch.no_grad()
+def prompt_lookup_generate(model, input_ids, source_ids, max_new_tokens, eos_token_id=None,
+                           stopping_criteria=None, max_ngram=3, num_draft=10):
+    """
+    Greedy decoding of a single prompt with drafts copied from `source_ids`.
+
+    Args:
+        model: Causal language model.
+        input_ids (torch.Tensor): Prompt of shape (1, prompt_length).
+        source_ids (list of int): Tokens drafts are copied from, i.e. the passage.
+        max_new_tokens (int): Maximum number of generated tokens.
+        eos_token_id (int, optional): Generation ends after this token.
+        stopping_criteria (callable, optional): Called like a transformers StoppingCriteria with
+            the full sequence after every step; generation ends when it returns True.
+        max_ngram (int): Longest n-gram matched against the source.
+        num_draft (int): Maximum number of draft tokens verified per forward pass.
+
+    Returns:
+        tuple: (generated token ids as a list, stats dict with forward passes, drafted and accepted tokens)
+    """
+    prompt = input_ids[0].tolist()
+    output = model(input_ids, use_cache=True)
+    past_key_values = output.past_key_values
+    cache_length = input_ids.shape[1]
+    generated = []
+    stats = {"forward_passes": 1, "drafted": 0, "accepted": 0}
+
+    def add_token(token):
+        """Append a token and tell whether greedy decoding would stop right after it."""
+        generated.append(token)
+        if token == eos_token_id or len(generated) >= max_new_tokens:
+            return True
+        return stopping_criteria is not None and bool(stopping_criteria(torch.tensor([prompt + generated]), None))
+
+    finished = add_token(int(output.logits[0, -1].argmax()))
+    while not finished:
+        draft = find_draft((prompt[-max_ngram:] + generated)[-max_ngram:], source_ids, max_ngram, num_draft)
+        draft = draft[:max_new_tokens - len(generated) - 1]
+
+        # The newest token is not in the cache yet, so it is scored together with the draft
+        candidate = torch.tensor([[generated[-1]] + draft], device=input_ids.device)
+        output = model(candidate, past_key_values=past_key_values, use_cache=True)
+        predicted = output.logits[0].argmax(dim=-1).tolist()
+
+        accepted = 0
+        while accepted < len(draft) and draft[accepted] == predicted[accepted]:
+            accepted += 1
+        # Stop conditions are checked after every token, like in plain greedy decoding,
+        # so the output ends at the same token even within an accepted draft
+        for token in draft[:accepted] + [predicted[accepted]]:
+            finished = add_token(token)
+            if finished:
+                break
+
+        # Drop the cache entries of rejected draft tokens
+        cache_length += 1 + accepted
+        past_key_values = crop_cache(output.past_key_values, cache_length)
+        stats["forward_passes"] += 1
+        stats["drafted"] += len(draft)
+        stats["accepted"] += accepted
+
+    return generated, stats
@@ -0,0 +1,421 @@
+"""
+HTTP service running the fine-tuned detector on (references, passage) pairs.
+
+The model is loaded once. Concurrent requests are collected into micro-batches: a batch
+is closed `--batch_window_ms` after its first request arrives or once it holds
+`--max_batch_size` requests, and is generated in one `generate_batch` call while the
+next batch fills up. Requests get the same prompt as convert_format.py builds for
+training, and the response holds the raw completion and the completion after the
+corrections of postprocess.py.
+
+The service is a plain ASGI application run by uvicorn.
+
+Endpoints:
+    POST /detect   {"references": str or list of str, "passage": str}
+                   -> {"raw": str, "postprocessed": str, "generated_tokens": int, "latency_ms": {...}}
+    POST /detect/stream
+                   same request, answered with newline-delimited JSON: {"text": str} for every new
+                   piece of the raw completion, then the /detect response with "done": true
+    GET  /metrics  queue depth, batch size histogram, latency percentiles and throughput
+    GET  /health
+
+Usage:
+    python serve.py --checkpoint_dir {checkpoint_dir} --port 8080 --max_batch_size 8 --batch_window_ms 20
+    curl -X POST localhost:8080/detect -d '{"references": "...", "passage": "..."}'
+"""
+import argparse
+import asyncio
+import json
+import sys
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import build_prompt
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        default=None,
+        help="checkpoint of the fine-tuned model")
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="host to bind")
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="port to bind")
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda",
+        choices=["cuda", "cpu"],
+        help="cuda: unsloth on GPU, cpu: transformers on CPU")
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default="int8",
+        choices=["int8", "none"],
+        help="weight quantization of the CPU backend")
+    parser.add_argument(
+        "--cpu_threads",
+        type=int,
+        default=None,
+        help="number of threads for CPU inference (default: all cores)")
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="maximum number of requests generated together")
+    parser.add_argument(
+        "--batch_window_ms",
+        type=float,
+        default=20,
+        help="how long a batch waits for more requests after its first one")
+    parser.add_argument(
+        "--max_new_tokens",
+        type=int,
+        default=2048,
+        help="upper bound on the generation length of any request")
+    parser.add_argument(
+        "--tag_allowance",
+        type=int,
+        default=256,
+        help="tokens allowed for tag markup on top of the passage length")
+    parser.add_argument(
+        "--greedy",
+        action="store_true",
+        help="greedy decoding instead of the sampling settings of phi_4_inference.py")
+    args = parser.parse_args()
+    return args
+
+
+def percentiles(values, quantiles=(0.5, 0.9, 0.99)):
+    values = sorted(values)
+    if not values:
+        return {}
+    return {f"p{round(q * 100)}": round(values[min(int(q * len(values)), len(values) - 1)], 1) for q in quantiles}
+
+
+class Detector:
+    """
+    Blocking batch generation: detection requests in, raw and postprocessed completions out.
+
+    Args:
+        model, tokenizer: As returned by phi_4_inference.load_model.
+        device (str): "cuda" or "cpu".
+        max_new_tokens (int): Upper bound on the generation length.
+        tag_allowance (int): Tokens allowed for tag markup on top of the passage length.
+        greedy (bool): Greedy decoding instead of sampling.
+    """
+
+    def __init__(self, model, tokenizer, device="cuda", max_new_tokens=2048, tag_allowance=256, greedy=False):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_new_tokens = max_new_tokens
+        self.tag_allowance = tag_allowance
+        self.greedy = greedy
+
+    def prepare(self, request):
+        """Prompt token ids, passage and generation budget of one request."""
+        from passage_stopping import extract_passage
+        from pretokenize import render_prompt
+
+        references = request["references"]
+        if not isinstance(references, str):
+            references = "\n\n".join(references)
+        prompt = build_prompt(references, request["passage"])
+        passage = extract_passage(prompt)
+        prompt_ids = self.tokenizer(render_prompt(self.tokenizer, prompt), add_special_tokens=False)["input_ids"]
+        passage_length = len(self.tokenizer(passage, add_special_tokens=False)["input_ids"])
+        return prompt_ids, passage, min(passage_length + self.tag_allowance, self.max_new_tokens)
+
+    def result(self, generated):
+        from postprocess import postprocess_response
+
+        response = self.tokenizer.decode(generated, skip_special_tokens=True)
+        return {"raw": response, "postprocessed": postprocess_response(response), "generated_tokens": len(generated)}
+
+    def __call__(self, requests):
+        from phi_4_inference import generate_batch
+
+        prompt_ids, passages, max_new_tokens = zip(*[self.prepare(request) for request in requests])
+        generated = generate_batch(
+            self.model, self.tokenizer, list(prompt_ids), list(passages), list(max_new_tokens),
+            self.device, greedy=self.greedy)
+        return [self.result(ids) for ids in generated]
+
+    def stream(self, request, on_text):
+        """Generate a single request, passing every new piece of the raw completion to `on_text`."""
+        from phi_4_inference import generate_batch
+        from streaming import CallbackStreamer
+
+        prompt_ids, passage, max_new_tokens = self.prepare(request)
+        generated = generate_batch(
+            self.model, self.tokenizer, [prompt_ids], [passage], [max_new_tokens],
+            self.device, greedy=self.greedy, streamer=CallbackStreamer(self.tokenizer, on_text))
+        return self.result(generated[0])
+
+
+class MicroBatcher:
+    """
+    Collect concurrent requests into batches for a blocking batch function.
+
+    The batch function runs on a single worker thread, so the event loop keeps accepting
+    requests while a batch is generated, and those requests form the next batch.
+
+    Args:
+        process (callable): Maps a list of requests to a list of results.
+        max_batch_size (int): Maximum number of requests per batch.
+        window_ms (float): How long a batch waits for more requests after its first one.
+        history (int): Number of recent requests kept for the latency percentiles.
+
+    Example:
+        >>> batcher = MicroBatcher(detector, max_batch_size=8, window_ms=20)
+        >>> batcher.start()    # inside the running event loop
+        >>> result = await batcher.submit({"references": ..., "passage": ...})
+    """
+
+    def __init__(self, process, max_batch_size=8, window_ms=20, history=1000):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+        self.started = time.time()
+        self.counts = Counter()
+        self.batch_sizes = Counter()
+        self.latencies = {name: deque(maxlen=history) for name in ["queue_ms", "generation_ms", "total_ms", "first_text_ms"]}
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future, time.perf_counter()))
+        return await future
+
+    async def stream(self, generate, request):
+        """
+        Run `generate(request, on_text)` for a single request on the model thread, between batches.
+
+        Yields every piece of text passed to `on_text` as soon as it is generated, and
+        finally the result of `generate` with its latencies.
+        """
+        loop = asyncio.get_running_loop()
+        pieces = asyncio.Queue()
+
+        def work():
+            try:
+                return generate(request, lambda text: loop.call_soon_threadsafe(pieces.put_nowait, text))
+            finally:
+                loop.call_soon_threadsafe(pieces.put_nowait, None)
+
+        enqueued = time.perf_counter()
+        future = loop.run_in_executor(self.executor, work)
+        first_text = None
+        while True:
+            text = await pieces.get()
+            if text is None:
+                break
+            first_text = first_text or time.perf_counter()
+            yield text
+        result = await future
+        end = time.perf_counter()
+
+        latency_ms = {"first_text_ms": ((first_text or end) - enqueued) * 1000, "total_ms": (end - enqueued) * 1000}
+        for name, value in latency_ms.items():
+            self.latencies[name].append(value)
+        self.counts["streams"] += 1
+        self.counts["generated_tokens"] += result.get("generated_tokens", 0)
+        yield dict(result, latency_ms={name: round(value, 1) for name, value in latency_ms.items()})
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            # Requests queued during the previous batch are taken without waiting
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, self.process, [request for request, _, _ in batch])
+            except Exception as error:
+                self.counts["failed_batches"] += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            end = time.perf_counter()
+
+            self.counts["batches"] += 1
+            self.counts["requests"] += len(batch)
+            self.batch_sizes[len(batch)] += 1
+            for (_, future, enqueued), result in zip(batch, results):
+                latency_ms = {
+                    "queue_ms": (start - enqueued) * 1000,
+                    "generation_ms": (end - start) * 1000,
+                    "total_ms": (end - enqueued) * 1000,
+                }
+                for name, value in latency_ms.items():
+                    self.latencies[name].append(value)
+                self.counts["generated_tokens"] += result.get("generated_tokens", 0)
+                if not future.done():
+                    future.set_result(dict(result, latency_ms={name: round(value, 1) for name, value in latency_ms.items()}))
+
+    def metrics(self):
+        uptime = time.time() - self.started
+        return {
+            "uptime_s": round(uptime, 1),
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "requests": self.counts["requests"],
+            "batches": self.counts["batches"],
+            "failed_batches": self.counts["failed_batches"],
+            "streams": self.counts["streams"],
+            "mean_batch_size": round(self.counts["requests"] / max(self.counts["batches"], 1), 2),
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "latency_ms": {name: percentiles(values) for name, values in self.latencies.items()},
+            "generated_tokens_per_s": round(self.counts["generated_tokens"] / max(uptime, 1e-9), 1),
+        }
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_json(send, status, body):
+    data = json.dumps(body).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())],
+    })
+    await send({"type": "http.response.body", "body": data})
+
+
+def validate_request(body):
+    """Return the detection request in a JSON body, or raise ValueError."""
+    request = json.loads(body or b"{}")
+    if not isinstance(request, dict):
+        raise ValueError("the request body must be a JSON object")
+    references, passage = request.get("references"), request.get("passage")
+    if isinstance(references, list) and all(isinstance(reference, str) for reference in references):
+        references = list(references)
+    elif not isinstance(references, str):
+        raise ValueError("`references` must be a string or a list of strings")
+    if not isinstance(passage, str) or not passage.strip():
+        raise ValueError("`passage` must be a non-empty string")
+    return {"references": references, "passage": passage}
+
+
+def make_app(batcher, stream=None):
+    """
+    ASGI application serving the detector through `batcher`.
+
+    `stream(request, on_text)` generates a single request for /detect/stream, e.g. `Detector.stream`.
+    """
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                batcher.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                batcher.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+            return
+        path, method = scope["path"].rstrip("/"), scope["method"]
+
+        if method == "GET" and path == "/health":
+            await send_json(send, 200, {"status": "ok"})
+        elif method == "GET" and path == "/metrics":
+            await send_json(send, 200, batcher.metrics())
+        elif method == "POST" and path == "/detect":
+            try:
+                request = validate_request(await read_body(receive))
+            except ValueError as error:  # includes malformed JSON
+                await send_json(send, 400, {"error": str(error)})
+                return
+            try:
+                result = await batcher.submit(request)
+            except Exception as error:
+                await send_json(send, 500, {"error": f"{type(error).__name__}: {error}"})
+                return
+            await send_json(send, 200, result)
+        elif method == "POST" and path == "/detect/stream" and stream is not None:
+            try:
+                request = validate_request(await read_body(receive))
+            except ValueError as error:
+                await send_json(send, 400, {"error": str(error)})
+                return
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/x-ndjson")]})
+            try:
+                async for item in batcher.stream(stream, request):
+                    line = {"text": item} if isinstance(item, str) else dict(item, done=True)
+                    await send({"type": "http.response.body", "body": (json.dumps(line) + "\n").encode("utf-8"), "more_body": True})
+            except Exception as error:
+                # The status is already sent, so the failure is reported in the stream
+                line = {"error": f"{type(error).__name__}: {error}", "done": True}
+                await send({"type": "http.response.body", "body": (json.dumps(line) + "\n").encode("utf-8"), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        else:
+            await send_json(send, 404, {"error": f"Unknown endpoint {method} {scope['path']}"})
+
+    return app
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    import uvicorn
+    from phi_4_inference import load_model
+
+    model, tokenizer = load_model(args.checkpoint_dir, args.device, args.quantize, args.cpu_threads)
+    detector = Detector(model, tokenizer, args.device, args.max_new_tokens, args.tag_allowance, args.greedy)
+    batcher = MicroBatcher(detector, args.max_batch_size, args.batch_window_ms)
+
+    uvicorn.run(make_app(batcher, detector.stream), host=args.host, port=args.port, lifespan="on")
@@ -0,0 +1,165 @@
+"""
+Data-parallel inference: run phi_4_inference.py as several shard workers and merge their outputs.
+
+Every worker handles the rows whose prompt hash falls into its shard
+(`--num_shards/--shard_id` of phi_4_inference.py) and writes them, with their input row
+position, to its own output file `{output_file}.shard{k}of{n}.{ext}`. The merge step
+puts the shard outputs back in input order and fails if a row is missing or duplicated.
+
+Usage:
+    # 4 workers, one per GPU
+    python shard_inference.py --input_file {input_file_path} --output_file {output_file_path} --num_shards 4 --devices 0,1,2,3 -- --checkpoint_dir {checkpoint_dir} --batch_size 8
+
+    # 2 CPU workers with 16 threads each
+    python shard_inference.py --input_file {input_file_path} --output_file {output_file_path} --num_shards 2 -- --checkpoint_dir {checkpoint_dir} --device cpu --cpu_threads 16
+
+    # across hosts: every host runs its shards, then one host merges
+    python shard_inference.py ... --num_shards 8 --shard_ids 4,5,6,7 -- --checkpoint_dir {checkpoint_dir}
+    python shard_inference.py --input_file {input_file_path} --output_file {output_file_path} --num_shards 8 --merge_only
+
+Arguments after `--` are passed to every worker.
+"""
+import argparse
+import subprocess
+import sys
+import os
+
+import pandas as pd
+
+# Add the parent directory to sys.path
+parent_dir = os.path.abspath(os.path.join(os.getcwd(), '..'))
+sys.path.append(parent_dir)
+from utils import read_table, write_table
+
+EVALUATION_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(EVALUATION_DIR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--input_file",
+        type=str,
+        default=None,
+        help="Input file for inference")
+    parser.add_argument(
+        "--output_file",
+        type=str,
+        default=None,
+        help="merged output file; shard outputs are written next to it")
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=1,
+        help="total number of shards across all hosts")
+    parser.add_argument(
+        "--shard_ids",
+        type=str,
+        default=None,
+        help="comma separated shards run on this host (default: all)")
+    parser.add_argument(
+        "--devices",
+        type=str,
+        default=None,
+        help="comma separated CUDA devices assigned to the workers in turn, e.g. 0,1,2,3")
+    parser.add_argument(
+        "--merge_only",
+        action="store_true",
+        help="only merge existing shard outputs")
+    parser.add_argument(
+        "worker_args",
+        nargs=argparse.REMAINDER,
+        help="arguments passed to phi_4_inference.py, after --")
+    args = parser.parse_args()
+    if args.num_shards < 2:
+        parser.error("--num_shards must be at least 2; run phi_4_inference.py directly for a single worker")
+    if args.worker_args[:1] == ["--"]:
+        args.worker_args = args.worker_args[1:]
+    return args
+
+
+def shard_path(output_file, shard_id, num_shards):
+    """Output file of one shard, e.g. out.parquet -> out.shard0of4.parquet"""
+    root, extension = os.path.splitext(output_file)
+    return f"{root}.shard{shard_id}of{num_shards}{extension}"
+
+
+def launch_workers(args, shard_ids):
+    """Start one phi_4_inference.py process per shard and wait for all of them; return the failed shards."""
+    devices = args.devices.split(",") if args.devices else []
+    # Workers import the shared root modules and the evaluation modules wherever they are started
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, EVALUATION_DIR, env.get("PYTHONPATH")]))
+
+    workers = {}
+    for i, shard_id in enumerate(shard_ids):
+        output_file = shard_path(args.output_file, shard_id, args.num_shards)
+        command = [
+            sys.executable, os.path.join(EVALUATION_DIR, "phi_4_inference.py"),
+            "--input_file", args.input_file,
+            "--output_file", output_file,
+            "--num_shards", str(args.num_shards),
+            "--shard_id", str(shard_id),
+        ] + args.worker_args
+        worker_env = dict(env)
+        if devices:
+            worker_env["CUDA_VISIBLE_DEVICES"] = devices[i % len(devices)]
+        log = open(output_file + ".log", "w")
+        print(f"Shard {shard_id}: {' '.join(command)} > {log.name}")
+        workers[shard_id] = (subprocess.Popen(command, env=worker_env, stdout=log, stderr=subprocess.STDOUT), log)
+
+    failed = []
+    for shard_id, (process, log) in workers.items():
+        if process.wait() != 0:
+            failed.append(shard_id)
+        log.close()
+    return failed
+
+
+def merge_shards(input_file, output_file, num_shards):
+    """
+    Merge the shard outputs back into one file in input row order.
+
+    Args:
+        input_file (str): Input file of the run, used for the expected number of rows.
+        output_file (str): Merged output file; shard outputs are looked up next to it.
+        num_shards (int): Number of shards of the run.
+
+    Returns:
+        pd.DataFrame: The merged output.
+
+    Raises:
+        ValueError: If a shard output is missing, or rows are missing or duplicated.
+    """
+    shard_files = [shard_path(output_file, shard_id, num_shards) for shard_id in range(num_shards)]
+    absent = [path for path in shard_files if not os.path.exists(path)]
+    if absent:
+        raise ValueError(f"Missing shard outputs: {absent}")
+
+    df = pd.concat([read_table(path) for path in shard_files], ignore_index=True)
+    num_rows = len(read_table(input_file, columns=["prompt"]))
+    duplicated = df['row_index'][df['row_index'].duplicated()].tolist()
+    missing = sorted(set(range(num_rows)) - set(df['row_index']))
+    if duplicated or missing or len(df) != num_rows:
+        raise ValueError(f"Shard outputs do not cover the input: {len(missing)} rows missing "
+                         f"(e.g. {missing[:10]}), {len(duplicated)} duplicated (e.g. {duplicated[:10]})")
+
+    df = df.sort_values('row_index').drop(columns=['row_index']).reset_index(drop=True)
+    write_table(df, output_file, index=False)
+    return df
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if not args.merge_only:
+        shard_ids = [int(i) for i in args.shard_ids.split(",")] if args.shard_ids else list(range(args.num_shards))
+        failed = launch_workers(args, shard_ids)
+        if failed:
+            sys.exit(f"Shards {failed} failed, see their logs; rerun them with `-- --resume` before merging")
+        if len(shard_ids) < args.num_shards:
+            print("Other shards run elsewhere; merge with --merge_only once all of them are done")
+            sys.exit(0)
+
+    df = merge_shards(args.input_file, args.output_file, args.num_shards)
+    print(f"Merged {args.num_shards} shards, {len(df)} rows, into {args.output_file}")
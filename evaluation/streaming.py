@@ -0,0 +1,30 @@
+"""
+Token streaming of detector completions.
+
+`generate_batch(..., streamer=CallbackStreamer(tokenizer, on_text))` generates a single
+prompt and hands every newly decoded piece of the completion to `on_text` while the
+model is still generating, so a client can show the tagged passage as it is written
+(see `tag_parser.close_open_tags` for rendering a partial completion).
+"""
+from transformers import TextStreamer
+
+
+class CallbackStreamer(TextStreamer):
+    """
+    TextStreamer passing the decoded text to a callback instead of printing it.
+
+    The prompt is skipped, and text is handed over once it can no longer change, which is
+    at word boundaries for most tokenizers.
+
+    Args:
+        tokenizer: Tokenizer of the model.
+        on_text (callable): Called with every new piece of the completion.
+    """
+
+    def __init__(self, tokenizer, on_text):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.on_text = on_text
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self.on_text(text)
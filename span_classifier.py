@@ -0,0 +1,159 @@
+import json
+import os
+from collections import OrderedDict
+
+from utils import (is_temporal, is_numerical, get_nlp, doc_contains_only_nouns_or_phrases, doc_contains_only_verbs_adj_adv,
+                   analyze_pos_batch, TAG_PAIR_PATTERN)
+
+# Categories a span can belong to
+TEMPORAL = "temporal"
+NUMERICAL = "numerical"
+NOUNS = "nouns"
+VERBS_ADJ_ADV = "verbs_adj_adv"
+
+
+class SpanClassifier:
+    """
+    Memoized classification of short tagged spans ("2019", "$1,598", "increased").
+
+    `classify` returns every category of a span in one call, so the regex checks and the
+    spaCy POS checks run once per distinct span instead of once per tag pair and stage.
+    Results are kept in a bounded LRU and can be persisted to a JSON file, so the verify
+    and postprocess stages share what the other one already classified.
+
+    Args:
+        max_size (int): Maximum number of spans kept in memory.
+        cache_file (str, optional): JSON file loaded on creation and written by `save`.
+
+    Example:
+        >>> classifier = SpanClassifier(cache_file="spans.json")
+        >>> classifier.prime(collect_tag_spans(df["response_w_tags"]))
+        >>> classifier.classify("$1,598")
+        frozenset({'numerical'})
+        >>> classifier.save()
+    """
+
+    def __init__(self, max_size=100000, cache_file=None):
+        self.max_size = max_size
+        self.cache_file = cache_file
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as f:
+                for span, categories in json.load(f).items():
+                    self._store(span, frozenset(categories))
+
+    def _store(self, span, categories):
+        self._cache[span] = categories
+        self._cache.move_to_end(span)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    @staticmethod
+    def _regex_categories(span):
+        categories = set()
+        if is_temporal(span):
+            categories.add(TEMPORAL)
+        if is_numerical(span):
+            categories.add(NUMERICAL)
+        return categories
+
+    def classify(self, span):
+        """Return the frozenset of categories of a span."""
+        span = span.strip()
+        categories = self._cache.get(span)
+        if categories is not None:
+            self.hits += 1
+            self._cache.move_to_end(span)
+            return categories
+
+        self.misses += 1
+        categories = self._regex_categories(span)
+        # correct_tags can fall through to the POS categories even for temporal or numerical
+        # spans (the other side of the pair may not match), so they are always computed;
+        # the span is parsed once for both checks
+        doc = get_nlp()(span)
+        if doc_contains_only_nouns_or_phrases(doc):
+            categories.add(NOUNS)
+        if doc_contains_only_verbs_adj_adv(doc):
+            categories.add(VERBS_ADJ_ADV)
+        categories = frozenset(categories)
+        self._store(span, categories)
+        return categories
+
+    def prime(self, spans, batch_size=1000):
+        """
+        Classify all spans not cached yet, running their POS checks in one batched spaCy call.
+
+        Args:
+            spans (iterable of str): Spans to classify, e.g. from `collect_tag_spans`.
+            batch_size (int): Number of spans per spaCy batch.
+        """
+        spans = [span.strip() for span in spans]
+        missing = [span for span in dict.fromkeys(spans) if span not in self._cache]
+        # Priming more spans than fit would only evict the ones primed first
+        missing = missing[-self.max_size:]
+        self.misses += len(missing)
+        for span, (nouns, verbs_adj_adv) in analyze_pos_batch(missing, batch_size).items():
+            categories = self._regex_categories(span)
+            if nouns:
+                categories.add(NOUNS)
+            if verbs_adj_adv:
+                categories.add(VERBS_ADJ_ADV)
+            self._store(span, frozenset(categories))
+
+    def save(self):
+        if self.cache_file is None:
+            return
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({span: sorted(categories) for span, categories in self._cache.items()}, f, ensure_ascii=False)
+        os.replace(tmp_file, self.cache_file)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "spans": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Process-wide classifier used by correct_tags when none is passed in
+shared_classifier = SpanClassifier()
+
+
+def correct_tags(text, classifier=None):
+    """
+    Corrects tag types in a given annotated text based on whether content is numerical, temporal, or relation.
+
+    Spans are classified through `classifier` (a `SpanClassifier`, the process-wide one by default).
+    """
+    classifier = classifier or shared_classifier
+
+    def correct_tag_type(old_tag, delete_val, mark_val):
+        """Determine the appropriate tag based on delete/mark values."""
+        shared = classifier.classify(delete_val) & classifier.classify(mark_val)
+        if TEMPORAL in shared:
+            return "temporal"
+        elif NUMERICAL in shared:
+            return "numerical"
+        elif NOUNS in shared:
+            return "entity"
+        elif VERBS_ADJ_ADV in shared:
+            return "relation"
+        else:
+            return old_tag
+
+    def replacer(match):
+        old_tag = match.group(1)
+        delete_val = match.group(2).strip()
+        mark_val = match.group(3).strip()
+
+        new_tag = correct_tag_type(old_tag, delete_val, mark_val)
+        return f"<{new_tag}><delete>{delete_val}</delete><mark>{mark_val}</mark></{new_tag}>"
+
+    return TAG_PAIR_PATTERN.sub(replacer, text)
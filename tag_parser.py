@@ -0,0 +1,196 @@
+"""
+Single-scan parser for the error-tag markup of generated passages.
+
+A tagged passage such as
+
+    Revenue <relation><delete>rose</delete><mark>fell</mark></relation> in 2019.
+    <unverifiable>Analysts expect growth.</unverifiable>
+
+is tokenized with one `finditer` pass over its tags and turned into a tree of `TagNode`s
+and plain text strings. Every tag is visited a constant number of times while building
+and rendering the tree, so the cost is O(n) in the passage length even for malformed
+model outputs (unclosed tags, stray closing tags, deep nesting) on which lazy `.*?`
+regexes over the whole passage degrade to quadratic time.
+
+Malformed markup is kept as literal text: a tag that is never closed is rendered with
+its opening tag and contents as they were, and a closing tag without a matching
+opening tag is left in place.
+"""
+import re
+from collections import Counter
+from functools import lru_cache
+
+# Passage-level tags wrap whole sentences, word-level tags a <delete>/<mark> pair
+PASSAGE_LEVEL_TAGS = ["contradictory", "unverifiable", "invented", "subjective"]
+WORD_LEVEL_TAGS = ["entity", "relation", "temporal", "numerical"]
+EDIT_TAGS = ["delete", "mark"]
+TAG_NAMES = PASSAGE_LEVEL_TAGS + WORD_LEVEL_TAGS + EDIT_TAGS
+# Model completions write the closing <contradictory> tag as an opening one (see
+# utils.swap_error_tags), so it is left out when checking or completing closing tags
+CLOSING_TAGS = [tag for tag in TAG_NAMES if tag != "contradictory"]
+# Start of a tag at the end of a partial completion, e.g. "<numer" or "</"
+PARTIAL_TAG = re.compile(r"</?[a-z]*$")
+
+
+@lru_cache(maxsize=None)
+def _tag_pattern(tags):
+    return re.compile(r"<(/?)(" + "|".join(map(re.escape, tags)) + r")>")
+
+
+class TagNode:
+    """
+    One tagged region of a passage.
+
+    Attributes:
+        tag (str): Tag name, None for the root of the tree.
+        children (list): Plain text strings and nested `TagNode`s, in passage order.
+        open_text (str): The opening tag as written in the passage.
+        close_text (str): The closing tag as written, None if the tag is never closed.
+    """
+
+    __slots__ = ("tag", "children", "open_text", "close_text")
+
+    def __init__(self, tag, open_text=""):
+        self.tag = tag
+        self.children = []
+        self.open_text = open_text
+        self.close_text = None
+
+    @property
+    def closed(self):
+        return self.close_text is not None
+
+    def child_tags(self):
+        """Return the tag names of the child nodes, ignoring plain text."""
+        return [child.tag for child in self.children if isinstance(child, TagNode)]
+
+    def __repr__(self):
+        return f"TagNode({self.tag!r}, children={len(self.children)}, closed={self.closed})"
+
+
+def parse_tags(text, tags=TAG_NAMES):
+    """
+    Parse a tagged passage into a tree in a single scan.
+
+    A closing tag closes the innermost open tag of the same name; tags opened inside it
+    and still open stay unclosed. Each open tag name is counted, so deciding whether a
+    closing tag has a match is O(1) and every node is popped at most once.
+
+    Args:
+        text (str): Tagged passage.
+        tags (list of str): Tag names to recognize; anything else is plain text.
+
+    Returns:
+        TagNode: Root node (tag None) holding the passage.
+
+    Example:
+        >>> root = parse_tags("<entity><delete>Acme</delete><mark>Globex</mark></entity> grew.")
+        >>> root.children
+        [TagNode('entity', children=2, closed=True), ' grew.']
+    """
+    root = TagNode(None)
+    stack = [root]
+    open_counts = Counter()
+    pos = 0
+
+    for match in _tag_pattern(tuple(tags)).finditer(text):
+        if match.start() > pos:
+            stack[-1].children.append(text[pos:match.start()])
+        pos = match.end()
+        is_closing, name = match.group(1) == "/", match.group(2)
+
+        if not is_closing:
+            node = TagNode(name, match.group(0))
+            stack[-1].children.append(node)
+            stack.append(node)
+            open_counts[name] += 1
+        elif open_counts[name]:
+            while True:
+                node = stack.pop()
+                open_counts[node.tag] -= 1
+                if node.tag == name:
+                    node.close_text = match.group(0)
+                    break
+        else:
+            # Stray closing tag
+            stack[-1].children.append(match.group(0))
+
+    if pos < len(text):
+        stack[-1].children.append(text[pos:])
+    return root
+
+
+def render(root, replace=None):
+    """
+    Render a tree back to text, optionally rewriting some nodes.
+
+    Rendering is iterative, so deeply nested input cannot hit the recursion limit.
+
+    Args:
+        root (TagNode): Tree from `parse_tags`.
+        replace (callable, optional): Called with every `TagNode`; returns None to keep the
+            node and its markup, or a list of text strings and nodes rendered in its place.
+
+    Returns:
+        str: The rendered passage. `render(parse_tags(text)) == text` for any text.
+    """
+    parts = []
+    pending = list(reversed(root.children))
+    while pending:
+        item = pending.pop()
+        if isinstance(item, str):
+            parts.append(item)
+            continue
+        replacement = replace(item) if replace is not None else None
+        if replacement is not None:
+            pending.extend(reversed(replacement))
+            continue
+        parts.append(item.open_text)
+        if item.closed:
+            pending.append(item.close_text)
+        pending.extend(reversed(item.children))
+    return "".join(parts)
+
+
+def iter_nodes(root):
+    """
+    Yield (node, ancestors) for every `TagNode` of the tree in passage order.
+
+    `ancestors` is a Counter of the tag names enclosing the node; it is shared and updated
+    in place while walking, so it must not be kept past the current step.
+    """
+    ancestors = Counter()
+    # Entries are (node, entering); a node is pushed again to leave it after its children
+    pending = [(child, True) for child in reversed(root.children) if isinstance(child, TagNode)]
+    while pending:
+        node, entering = pending.pop()
+        if not entering:
+            ancestors[node.tag] -= 1
+            continue
+        yield node, ancestors
+        ancestors[node.tag] += 1
+        pending.append((node, False))
+        pending.extend((child, True) for child in reversed(node.children) if isinstance(child, TagNode))
+
+
+def is_edit_pair(node):
+    """Check if a closed word-level node holds exactly `<delete>...</delete><mark>...</mark>`."""
+    children = node.children
+    return (len(children) == 2
+            and all(isinstance(child, TagNode) and child.closed for child in children)
+            and children[0].tag == "delete" and children[1].tag == "mark")
+
+
+def close_open_tags(text, tags=CLOSING_TAGS):
+    """
+    Make a partial completion renderable while it is still being generated.
+
+    A tag cut off at the end of the text is dropped, and every tag still open is closed
+    after its contents.
+
+    Example:
+        >>> close_open_tags("Revenue <relation><delete>rose</delete><mark>fe")
+        'Revenue <relation><delete>rose</delete><mark>fe</mark></relation>'
+    """
+    text = PARTIAL_TAG.sub("", text)
+    return render(parse_tags(text, tags), lambda node: None if node.closed else [node.open_text] + node.children + [f"</{node.tag}>"])
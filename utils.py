@@ -3,12 +3,23 @@ import string
 from dateutil.parser import parse as date_parse
 from dateutil.parser import ParserError
 import json
+import pandas as pd
+import os
 import json_repair
 from json_repair import repair_json
-import spacy
+from functools import lru_cache
+from tag_parser import parse_tags, render, iter_nodes, is_edit_pair, WORD_LEVEL_TAGS
 
-# Load the English NLP model
-nlp = spacy.load("en_core_web_sm")
+@lru_cache(maxsize=None)
+def get_nlp():
+    """
+    Return the English spaCy model, loaded on first use and shared by the whole process.
+
+    Loading takes seconds, so scripts that never look at parts of speech (e.g. convert_format.py)
+    do not pay for it at import time.
+    """
+    import spacy
+    return spacy.load("en_core_web_sm")
 
 def contain_nested_tags(tags, text):
     """
@@ -30,25 +41,11 @@ def contain_nested_tags(tags, text):
         >>> contain_nested_tags(tags, text)
         True
     """
-    tag_pattern = re.compile(r"</?(" + "|".join(tags) + r")>")
-    stack = []
-    errors = []
-
-    for match in tag_pattern.finditer(text):
-        tag = match.group(0)
-        tag_name = match.group(1)
-        position = match.start()
-
-        if tag.startswith("</"):
-            if stack:
-                open_tag, open_pos = stack.pop()
-                if any(inner_tag != open_tag for inner_tag, _ in stack):
-                    # Found a nested tag
-                    errors.append((open_tag, tag_name, open_pos, position))
-        else:
-            stack.append((tag_name, position))
-
-    return errors!=[]
+    # A tag opened inside a tag of a different type, whether or not either is closed
+    for node, ancestors in iter_nodes(parse_tags(text, tags)):
+        if sum(ancestors.values()) > ancestors[node.tag]:
+            return True
+    return False
 
 
 def recover_original_string(text):
@@ -73,24 +70,18 @@ def recover_original_string(text):
         >>> recover_original_string(input_text)
         'Revenue increased.'
     """
-    # Step 1: Remove contradictory sections entirely
-    text = re.sub(r"<contradictory>.*?</contradictory>", "", text, flags=re.DOTALL)
-
-    # Step 2: Remove unverifiable sections entirely
-    text = re.sub(r"<unverifiable>.*?</unverifiable>", "", text, flags=re.DOTALL)
-    
-    # Step 3: Replace <entity><delete>...</delete><mark>...</mark></entity> with just the <delete> content
-    text = re.sub(r"<entity><delete>(.*?)</delete><mark>.*?</mark></entity>", r"\1", text, flags=re.DOTALL)
-
-    # Step 4: Replace <numerical><delete>...</delete><mark>...</mark></numerical> with just the <delete> content
-    text = re.sub(r"<numerical><delete>(.*?)</delete><mark>.*?</mark></numerical>", r"\1", text, flags=re.DOTALL)
-
-    # Step 5: Replace <temporal><delete>...</delete><mark>...</mark></temporal> with just the <delete> content
-    text = re.sub(r"<temporal><delete>(.*?)</delete><mark>.*?</mark></temporal>", r"\1", text, flags=re.DOTALL)
-
-    # Step 6: Replace <relation><delete>...</delete><mark>...</mark></relation> with just the <delete> content
-    text = re.sub(r"<relation><delete>(.*?)</delete><mark>.*?</mark></relation>", r"\1", text, flags=re.DOTALL)
-    
+    def replace(node):
+        if not node.closed:
+            return None
+        # Remove contradictory and unverifiable sections entirely
+        if node.tag in ["contradictory", "unverifiable"]:
+            return []
+        # Replace <entity|numerical|temporal|relation><delete>...</delete><mark>...</mark></...> with the <delete> content
+        if node.tag in WORD_LEVEL_TAGS and is_edit_pair(node):
+            return node.children[0].children
+        return None
+
+    text = render(parse_tags(text), replace)
     return text.strip()
 
 
@@ -121,10 +112,7 @@ def replace_tag_with_new_tag(text, old_tag, new_tag):
     pattern = fr"</?{old_tag}>"
     return re.sub(pattern, lambda m: f"</{new_tag}>" if m.group(0).startswith("</") else f"<{new_tag}>", text)
 
-def contains_only_nouns_or_phrases(text):
-    # Process the text
-    doc = nlp(text)
-
+def doc_contains_only_nouns_or_phrases(doc):
     # Check if all tokens are either nouns or noun phrases
     for token in doc:
         if token.pos_ not in ["NOUN", "PROPN"] and not token.dep_ == "nsubj":
@@ -132,18 +120,23 @@ def contains_only_nouns_or_phrases(text):
     
     return True
 
-def contains_only_verbs_adj_adv(text):
-    # Process the text with spaCy
-    doc = nlp(text)
-
+def doc_contains_only_verbs_adj_adv(doc):
     # Check if every token is a verb, adjective, or adverb
     for token in doc:
         if token.pos_ not in ["VERB", "ADJ", "ADV"]:
             return False
     return True
 
+def contains_only_nouns_or_phrases(text):
+    # Process the text
+    return doc_contains_only_nouns_or_phrases(get_nlp()(text))
+
+def contains_only_verbs_adj_adv(text):
+    # Process the text with spaCy
+    return doc_contains_only_verbs_adj_adv(get_nlp()(text))
+
 def contains_only_articles_or_demonstratives(text):
-    doc = nlp(text)
+    doc = get_nlp()(text)
 
     for token in doc:
         # Keep only tokens that are determiners (DET) with tag DT (i.e., articles or demonstratives)
@@ -158,6 +151,15 @@ def replace_tagged_with_mark(text):
     return re.sub(pattern, r"\2", text)
 
 
+# Precompiled patterns for is_temporal / is_numerical, which run on every tagged span
+YEAR_PATTERN = re.compile(r'(19|20)\d{2}')
+QUARTER_PATTERN = re.compile(r'\bQ[1-4]\s?(19|20)\d{2}\b', re.IGNORECASE)
+FISCAL_YEAR_PATTERN = re.compile(r'\bFY\s?(19|20)\d{2}\b', re.IGNORECASE)
+MONTH_PATTERN = re.compile(r'(January|February|March|April|May|June|July|August|September|October|November|December|'
+                           r'Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)', re.IGNORECASE)
+NUMBER_WORDS_PATTERN = re.compile(r'^[\d,.]+(\.\d+)?\s*(thousand|million|billion|trillion|k|m|bn)?$', re.IGNORECASE)
+NUMBER_FORMATTING_PATTERN = re.compile(r'[,\$%()]')
+
 def is_temporal(text):
     """
     Checks if the string contains temporal information such as years, quarters, months, or dates.
@@ -165,20 +167,19 @@ def is_temporal(text):
     text = text.strip()
 
     # Match exact 4-digit years from 1900 to 2099
-    if re.fullmatch(r'(19|20)\d{2}', text):
+    if YEAR_PATTERN.fullmatch(text):
         return True
 
     # Match quarter + year
-    if re.search(r'\bQ[1-4]\s?(19|20)\d{2}\b', text, re.IGNORECASE):
+    if QUARTER_PATTERN.search(text):
         return True
 
     # Match fiscal year
-    if re.search(r'\bFY\s?(19|20)\d{2}\b', text, re.IGNORECASE):
+    if FISCAL_YEAR_PATTERN.search(text):
         return True
 
     # Full or abbreviated month names only
-    if re.fullmatch(r'(January|February|March|April|May|June|July|August|September|October|November|December|'
-                    r'Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)', text, re.IGNORECASE):
+    if MONTH_PATTERN.fullmatch(text):
         return True
 
 
@@ -197,15 +198,15 @@ def is_numerical(text):
     text = text.strip()
 
     # If it's a standalone year, treat it as temporal
-    if re.fullmatch(r'(19|20)\d{2}', text):
+    if YEAR_PATTERN.fullmatch(text):
         return False
 
     # Match numerical words like 8 million, 2.5 billion, etc.
-    if re.match(r'^[\d,.]+(\.\d+)?\s*(thousand|million|billion|trillion|k|m|bn)?$', text, re.IGNORECASE):
+    if NUMBER_WORDS_PATTERN.match(text):
         return True
 
     # Remove formatting characters
-    cleaned = re.sub(r'[,\$%()]', '', text)
+    cleaned = NUMBER_FORMATTING_PATTERN.sub('', text)
     try:
         float(cleaned)
         return True
@@ -228,48 +229,69 @@ def match_lower_precision(a, b):
 
 
 ## for converting format
+# Prompt shown to the detection model around the reference and the passage
+PROMPT_PREFIX = "Read the following references:\n"
+PROMPT_INSTRUCTION = "\nPlease identify all the errors in the following text using the information in the references provided and suggest edits:\nText: "
+
+def build_prompt(evidence, passage):
+    """
+    Build the detection prompt for a passage.
+
+    Works on single strings as well as on whole pandas Series, where the concatenation is
+    done column-wise.
+    """
+    return PROMPT_PREFIX + evidence + PROMPT_INSTRUCTION + passage
+
+# Error and <mark> tags, removed while the <delete> spans are dropped with their content
+ERROR_TOKENS = ['<entity>', '<relation>', '<contradictory>', '<unverifiable>', '<invented>', '<subjective>', '<temporal>', '<numerical>', '<mark>',
+                '</entity>', '</relation>', '</contradictory>', '</unverifiable>', '</invented>', '</subjective>', '</temporal>', '</numerical>', '</mark>']
+ERROR_TOKEN_PATTERN = re.compile("|".join(map(re.escape, ERROR_TOKENS)))
+
 # removes <mark>, <delete>, and other error tokens from passage
 def remove_error_tags(token_passage):
-    error_tokens = ['<entity>', '<relation>', '<contradictory>', '<unverifiable>', '<invented>', '<subjective>', '<temporal>', '<numerical>', '<mark>',
-                    '</entity>', '</relation>', '</contradictory>', '</unverifiable>', '</invented>', '</subjective>', '</temporal>', '</numerical>', '</mark>']
-    for tok in error_tokens:
-        token_passage = token_passage.replace(tok, "")
+    token_passage = ERROR_TOKEN_PATTERN.sub("", token_passage)
     if "<delete>" not in token_passage:
         return token_passage
-    else:
-        count = 0
-        while "<delete>" in token_passage and "</delete>" in token_passage and count < 10:
-            next_delete_start_index = token_passage.index("<delete>")
-            next_delete_end_index = token_passage.index("</delete>")
-            deleted_part = token_passage[next_delete_start_index:(next_delete_end_index + 9)]
-            token_passage = token_passage.replace(deleted_part, "")
-            count += 1
+
+    # Drop every <delete>...</delete> span in one left-to-right scan
+    parts = []
+    pos = 0
+    while True:
+        start = token_passage.find("<delete>", pos)
+        if start == -1:
+            break
+        end = token_passage.find("</delete>", start)
+        if end == -1:
+            break
+        parts.append(token_passage[pos:start])
+        pos = end + len("</delete>")
+    parts.append(token_passage[pos:])
+    token_passage = "".join(parts)
 
     token_passage = token_passage.replace("</s>", "")
     return token_passage
     
+# <mark> and <delete> trade places, passage-level contradictions become deletions
+SWAP_TOKENS = {
+    "<mark>": "<delete>", "</mark>": "</delete>",
+    "<delete>": "<mark>", "</delete>": "</mark>",
+    "<contradictory>": "<contradictory><delete>", "</contradictory>": "</delete><contradictory>",
+    "</s>": "",
+}
+SWAP_PATTERN = re.compile("|".join(map(re.escape, SWAP_TOKENS)))
+
+def swap_token(match):
+    return SWAP_TOKENS[match.group(0)]
+
 def swap_error_tags(token_passage):
-    token_passage = token_passage.replace("<mark>", "<d>")
-    token_passage = token_passage.replace("</mark>", "</d>")
-    token_passage = token_passage.replace("<delete>", "<mark>")
-    token_passage = token_passage.replace("</delete>", "</mark>")
-    token_passage = token_passage.replace("<d>", "<delete>")
-    token_passage = token_passage.replace("</d>", "</delete>")
-    token_passage = token_passage.replace("<contradictory>", "<contradictory><delete>")
-    token_passage = token_passage.replace("</contradictory>", "</delete><contradictory>")
-  #  print(token_passage)
-    token_passage = token_passage.replace("</s>", "")
-    return token_passage
+    # One pass over the passage instead of a str.replace per token
+    return SWAP_PATTERN.sub(swap_token, token_passage)
 
 ## for recovering text from response
 def remove_tagged_spans(text):
-    # Define patterns for all tags
+    # Drop every closed <tag>...</tag> section of these tags
     tags = ["unverifiable", "contradictory", "invented", "subjective"]
-    for tag in tags:
-        # Pattern to match <tag>...</tag>, non-greedy match in between
-        pattern = fr"<{tag}>.*?</{tag}>"
-        text = re.sub(pattern, "", text, flags=re.DOTALL)
-    return text
+    return render(parse_tags(text), lambda node: [] if node.closed and node.tag in tags else None)
 
 ## for tag statistics
 def contains_error_tags(error_tags, text):
@@ -359,3 +381,177 @@ def extract_references_and_passage(text: str):
 
     return reference, passage
 
+
+## for checkpointing long runs
+def append_jsonl(path, records):
+    """
+    Append records to a JSONL journal and flush them to disk.
+
+    Each record is written as one line, so a crash can at most leave a truncated
+    final line, which `read_jsonl` skips.
+
+    Args:
+        path (str): Path of the journal file.
+        records (list of dict): JSON-serializable records to append.
+    """
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def rewrite_jsonl(path, records):
+    """
+    Replace a JSONL journal with `records` atomically.
+
+    The records are written to a temporary file that is moved into place, so a crash
+    during the rewrite leaves the previous journal intact.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_jsonl(path):
+    """
+    Read all complete records from a JSONL journal.
+
+    Returns an empty list if the file does not exist. A partially written last line
+    (e.g. from a process killed mid-write) is ignored.
+    """
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+## for reading and writing pipeline artifacts
+# Columns holding the same reference text for many rows, stored dictionary-encoded
+DICTIONARY_COLUMNS = ["documents"]
+
+def get_table_format(path):
+    """Return "parquet", "arrow" or "csv" based on the file extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".parquet":
+        return "parquet"
+    if ext in [".arrow", ".feather"]:
+        return "arrow"
+    return "csv"
+
+def read_table(path, columns=None):
+    """
+    Read a pipeline artifact into a DataFrame, choosing the format from the file extension.
+
+    Parquet and Arrow/Feather files are memory-mapped and only the requested columns
+    are read, so e.g. a stage that needs `response_w_tags` never parses `documents`.
+
+    Args:
+        path (str): .parquet, .arrow/.feather or .csv file.
+        columns (list of str, optional): Columns to load; all columns if None.
+
+    Returns:
+        pd.DataFrame: The loaded table.
+    """
+    table_format = get_table_format(path)
+    if table_format == "parquet":
+        return pd.read_parquet(path, columns=columns, memory_map=True)
+    if table_format == "arrow":
+        import pyarrow.feather as feather
+        return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+    return pd.read_csv(path, usecols=columns)
+
+def iter_table(path, chunk_size, columns=None):
+    """Yield a pipeline artifact as DataFrames of at most `chunk_size` rows."""
+    table_format = get_table_format(path)
+    if table_format == "parquet":
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif table_format == "arrow":
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        for batch in table.to_batches(max_chunksize=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, chunksize=chunk_size)
+
+def write_table(df, path, index=True):
+    """
+    Write a pipeline artifact, choosing the format from the file extension.
+
+    For Parquet and Arrow/Feather output, repeated reference columns (DICTIONARY_COLUMNS)
+    are stored dictionary-encoded.
+    """
+    table_format = get_table_format(path)
+    if table_format == "csv":
+        df.to_csv(path, index=index)
+        return
+
+    df = df.copy()
+    for column in DICTIONARY_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    if table_format == "parquet":
+        df.to_parquet(path, index=index)
+    else:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=index), path)
+
+## for batched tag-type correction
+# Word-level tag pairs whose type is corrected by correct_tags
+TAG_PAIR_PATTERN = re.compile(r"<(entity|temporal|numerical|relation)><delete>(.*?)</delete><mark>(.*?)</mark></\1>", re.DOTALL)
+
+def collect_tag_spans(texts):
+    """
+    Collect the delete/mark spans of all tag pairs whose type is checked by `correct_tags`.
+
+    Args:
+        texts (iterable of str): Tagged passages.
+
+    Returns:
+        list of str: Unique stripped spans, in order of first occurrence.
+    """
+    spans = {}
+    for text in texts:
+        for _, delete_val, mark_val in TAG_PAIR_PATTERN.findall(text):
+            spans[delete_val.strip()] = None
+            spans[mark_val.strip()] = None
+    return list(spans)
+
+def analyze_pos_batch(spans, batch_size=1000):
+    """
+    Evaluate the POS predicates of many spans with a single `nlp.pipe` call.
+
+    Named entity recognition and lemmatization are skipped (the noun check needs the
+    parser's `nsubj` dependencies), and every distinct span is processed once.
+
+    Args:
+        spans (list of str): Spans to analyze.
+        batch_size (int): Number of spans per spaCy batch.
+
+    Returns:
+        dict: span -> (contains_only_nouns_or_phrases, contains_only_verbs_adj_adv)
+
+    Example:
+        >>> pos_lookup = analyze_pos_batch(collect_tag_spans(df["response_w_tags"]))
+    """
+    spans = list(dict.fromkeys(spans))
+    nlp = get_nlp()
+    # Only components no predicate reads are disabled; tok2vec and attribute_ruler feed pos_ in spaCy 3
+    disable = [name for name in ("ner", "lemmatizer") if name in nlp.pipe_names]
+    docs = nlp.pipe(spans, batch_size=batch_size, disable=disable)
+    return {span: (doc_contains_only_nouns_or_phrases(doc), doc_contains_only_verbs_adj_adv(doc))
+            for span, doc in zip(spans, docs)}